@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Convert a SUMO .net.xml network into plain xml files without netconvert.
+
+The network is streamed twice: the first pass collects the few relations the
+plain files need (edge end nodes, traffic lights of each node, edges with
+connections), the second pass writes the .nod.xml, .edg.xml, .con.xml,
+.tll.xml and .typ.xml files element by element.
+
+The conversion follows the plain-xml writer of netconvert for the attributes
+netdiff compares, so that netdiff --native writes the same diff as with the
+plain files of netconvert. Like netconvert, nodes without connections are
+written as dead ends, whatever type the network stores (e.g. at the border
+of a subnetwork cut out of a larger network). The remaining differences do
+not change the diff elements:
+- the plain files get the version of the network instead of the one of
+  netconvert, and no location if the network has none (taz_to_net.py
+  subnetworks), netdiff ignores a location only found in the modified network
+- the edge types file is also written (empty) for networks without types
+- other values netconvert recomputes while loading are kept as stored, which
+  only matters for networks written by older versions of netconvert
+
+Usage:
+    python net2plain.py <network_file> <output_prefix>
+"""
+import argparse
+import re
+from collections import namedtuple
+from xml.sax.saxutils import escape
+
+from sumolib.net.lane import get_allowed
+
+try:
+    from lxml.etree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+TYPE_NODES = ".nod.xml"
+TYPE_EDGES = ".edg.xml"
+TYPE_CONNECTIONS = ".con.xml"
+TYPE_TLLOGICS = ".tll.xml"
+TYPE_EDGETYPES = ".typ.xml"
+
+ROOTS = {
+    TYPE_NODES: ("nodes", "nodes_file.xsd"),
+    TYPE_EDGES: ("edges", "edges_file.xsd"),
+    TYPE_CONNECTIONS: ("connections", "connections_file.xsd"),
+    TYPE_TLLOGICS: ("tlLogics", "tllogic_file.xsd"),
+    TYPE_EDGETYPES: ("types", "types_file.xsd"),
+}
+
+# junction attributes copied to the plain node when present
+NODE_ATTRS = ("radius", "keepClear", "rightOfWay", "fringe", "name", "controlledInner")
+# edge attributes copied to the plain edge when present
+EDGE_ATTRS = ("name", "type", "shape", "spreadType", "distance")
+# lane attributes written on the edge when all lanes share the same value
+UNIFORM_LANE_ATTRS = ("speed", "width", "endOffset", "friction")
+# lane attributes that are always lane specific
+LANE_ATTRS = ("acceleration", "type", "changeLeft", "changeRight")
+# net connection attributes computed by netconvert, not part of the plain input
+COMPUTED_CONNECTION_ATTRS = set(["via", "tl", "linkIndex", "linkIndex2", "dir", "state"])
+# junction types of internal nodes
+INTERNAL_JUNCTION = "internal"
+# node type netconvert assigns to nodes without connections
+DEAD_END = "dead_end"
+CROSSING_ID = re.compile(r"^:(.*)_c\d+$")
+
+# relations gathered by the first pass over the network, see collect
+NetInfo = namedtuple("NetInfo", ["edge_to", "node_tls", "tl_types", "crossings",
+                                 "unconnected", "connected_nodes", "has_shapes"])
+
+
+def quote(value):
+    return escape(value, {'"': "&quot;"})
+
+
+def attr_string(items):
+    """
+    Return the xml attributes for the (name, value) items, skipping None values.
+    """
+    return "".join(' %s="%s"' % (name, quote(value)) for name, value in items if value is not None)
+
+
+def write_copy(out, elem, level=1):
+    """
+    Write elem and its element children unchanged.
+    """
+    indent = "    " * level
+    children = [child for child in elem if isinstance(child.tag, str)]
+    attrs = attr_string(elem.attrib.items())
+    if not children:
+        out.write('%s<%s%s/>\n' % (indent, elem.tag, attrs))
+        return
+    out.write('%s<%s%s>\n' % (indent, elem.tag, attrs))
+    for child in children:
+        write_copy(out, child, level + 1)
+    out.write('%s</%s>\n' % (indent, elem.tag))
+
+
+def write_element(out, tag, items, children=(), level=1):
+    """
+    Write an element with the given attributes and children, which are
+    copied unchanged.
+    """
+    indent = "    " * level
+    if not children:
+        out.write('%s<%s%s/>\n' % (indent, tag, attr_string(items)))
+        return
+    out.write('%s<%s%s>\n' % (indent, tag, attr_string(items)))
+    for child in children:
+        write_copy(out, child, level + 1)
+    out.write('%s</%s>\n' % (indent, tag))
+
+
+def iter_top_level(net_file):
+    """
+    Yield the root element, then every child of the root once it is complete.
+    Handled children are removed from the tree to keep memory constant.
+    """
+    depth = 0
+    root = None
+    for event, elem in iterparse(net_file, events=("start", "end")):
+        if event == "start":
+            if depth == 0:
+                root = elem
+                yield elem
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield elem
+                root.remove(elem)
+
+
+def is_normal_edge(elem):
+    return elem.get("function", "normal") == "normal"
+
+
+def edge_permissions(elem, cache):
+    """
+    Return the set of vehicle classes allowed on any lane of the edge.
+    """
+    key = tuple((lane.get("allow"), lane.get("disallow")) for lane in elem if lane.tag == "lane")
+    if key not in cache:
+        allowed = set()
+        for allow, disallow in key:
+            allowed |= get_allowed(allow, disallow)
+        cache[key] = frozenset(allowed)
+    return cache[key]
+
+
+def collect(net_file):
+    """
+    First pass: return a NetInfo with the to-node of every normal edge, the
+    sorted traffic light ids controlling each node, the type of each traffic
+    light, the (priority, linkIndex) of each crossing, the edges without
+    connections netconvert lists explicitly, the nodes with connections and
+    whether edges have a custom shape.
+    """
+    edge_to = {}
+    edge_perm = {}
+    node_out_perm = {}
+    perm_cache = {}
+    node_tls = {}
+    tl_types = {}
+    crossings = {}
+    connected = set()
+    has_shapes = False
+    elements = iter_top_level(net_file)
+    next(elements)
+    for elem in elements:
+        if elem.tag == "edge" and is_normal_edge(elem):
+            edge_to[elem.get("id")] = elem.get("to")
+            permissions = edge_permissions(elem, perm_cache)
+            edge_perm[elem.get("id")] = permissions
+            node_out_perm[elem.get("from")] = node_out_perm.get(elem.get("from"), frozenset()) | permissions
+            has_shapes = has_shapes or elem.get("shape") is not None
+        elif elem.tag == "edge" and elem.get("function") == "crossing":
+            crossings[elem.get("id")] = ("0", None)
+        elif elem.tag == "connection":
+            from_edge = elem.get("from")
+            if elem.get("to") in crossings:
+                # the link from the walking area into the crossing decides its priority
+                crossings[elem.get("to")] = ("1" if elem.get("state") == "M" else "0", elem.get("linkIndex"))
+            elif from_edge in edge_to and elem.get("to") in edge_to:
+                connected.add(from_edge)
+                if elem.get("tl") is not None:
+                    node_tls.setdefault(edge_to[from_edge], set()).add(elem.get("tl"))
+        elif elem.tag == "tlLogic":
+            tl_types[elem.get("id")] = elem.get("type", "static")
+
+    # like netconvert, keep edges without connections whose vehicles could
+    # continue at the end node, the loss of connections is intended there
+    unconnected = []
+    for edge, to_node in edge_to.items():
+        if edge not in connected:
+            shared = edge_perm[edge] & node_out_perm.get(to_node, frozenset())
+            if shared and shared != set(["pedestrian"]):
+                unconnected.append(edge)
+    node_tls = {node: sorted(tls) for node, tls in node_tls.items()}
+    connected_nodes = set(edge_to[edge] for edge in connected)
+    return NetInfo(edge_to, node_tls, tl_types, crossings, unconnected, connected_nodes, has_shapes)
+
+
+def write_node(out, elem, info):
+    if elem.get("type") == INTERNAL_JUNCTION or elem.get("id", "").startswith(":"):
+        return
+    items = [(name, elem.get(name)) for name in ("id", "x", "y", "z")]
+    # netconvert turns nodes without connections into dead ends when computing their logic
+    items.append(("type", elem.get("type") if elem.get("id") in info.connected_nodes else DEAD_END))
+    tls = info.node_tls.get(elem.get("id"))
+    if tls:
+        items.append(("tl", " ".join(tls)))
+        tl_type = info.tl_types.get(tls[0], "static")
+        if tl_type != "static":
+            items.append(("tlType", tl_type))
+    if elem.get("customShape") in ("1", "true"):
+        items.append(("shape", elem.get("shape")))
+    items += [(name, elem.get(name)) for name in NODE_ATTRS]
+    write_element(out, "node", items, [child for child in elem if child.tag == "param"])
+
+
+def write_edge(out, elem):
+    lanes = [child for child in elem if child.tag == "lane"]
+    items = [(name, elem.get(name)) for name in ("id", "from", "to", "priority")]
+    items += [(name, elem.get(name)) for name in EDGE_ATTRS]
+    items.append(("numLanes", str(len(lanes))))
+
+    lane_items = [[("index", lane.get("index"))] for lane in lanes]
+    permissions = [(lane.get("allow"), lane.get("disallow")) for lane in lanes]
+    if len(set(permissions)) <= 1:
+        if lanes:
+            items += [("allow", permissions[0][0]), ("disallow", permissions[0][1])]
+    else:
+        for lane_item, (allow, disallow) in zip(lane_items, permissions):
+            lane_item += [("allow", allow), ("disallow", disallow)]
+    for name in UNIFORM_LANE_ATTRS:
+        values = [lane.get(name) for lane in lanes]
+        if len(set(values)) <= 1:
+            if lanes:
+                items.append((name, values[0]))
+        else:
+            for lane_item, value in zip(lane_items, values):
+                lane_item.append((name, value))
+    for lane, lane_item in zip(lanes, lane_items):
+        lane_item += [(name, lane.get(name)) for name in LANE_ATTRS]
+        if lane.get("customShape") in ("1", "true"):
+            lane_item.append(("shape", lane.get("shape")))
+
+    indent = "    "
+    edge_children = [child for child in elem if isinstance(child.tag, str) and child.tag != "lane"]
+    written_lanes = []
+    for lane, lane_item in zip(lanes, lane_items):
+        lane_children = [child for child in lane if isinstance(child.tag, str)]
+        if lane_children or any(value is not None for _, value in lane_item[1:]):
+            written_lanes.append((lane_item, lane_children))
+    if not written_lanes and not edge_children:
+        out.write('%s<edge%s/>\n' % (indent, attr_string(items)))
+        return
+    out.write('%s<edge%s>\n' % (indent, attr_string(items)))
+    for lane_item, lane_children in written_lanes:
+        write_element(out, "lane", lane_item, lane_children, 2)
+    for child in edge_children:
+        write_copy(out, child, 2)
+    out.write('%s</edge>\n' % indent)
+
+
+def write_crossing(out, elem, info):
+    match = CROSSING_ID.match(elem.get("id", ""))
+    if match is None:
+        return
+    priority, link_index = info.crossings[elem.get("id")]
+    items = [("node", match.group(1)), ("edges", elem.get("crossingEdges")), ("priority", priority)]
+    lanes = [child for child in elem if child.tag == "lane"]
+    if lanes:
+        items.append(("width", lanes[0].get("width")))
+    items.append(("linkIndex", link_index))
+    if lanes:
+        items.append(("outlineShape", lanes[0].get("outlineShape")))
+    write_element(out, "crossing", items)
+
+
+def write_connection(outputs, elem, info):
+    from_edge = elem.get("from")
+    if from_edge not in info.edge_to or elem.get("to") not in info.edge_to:
+        # connection of an internal lane or to a walking area
+        return
+    items = [(name, value) for name, value in elem.attrib.items() if name not in COMPUTED_CONNECTION_ATTRS]
+    if elem.get("tl") is None and info.edge_to[from_edge] in info.node_tls:
+        items.append(("uncontrolled", "1"))
+    write_element(outputs[TYPE_CONNECTIONS], "connection", items, [child for child in elem if child.tag == "param"])
+    if elem.get("tl") is not None:
+        write_element(outputs[TYPE_TLLOGICS], "connection",
+                      [(name, elem.get(name)) for name in ("from", "to", "fromLane", "toLane",
+                                                           "tl", "linkIndex", "linkIndex2")])
+
+
+def convert(net_file, prefix):
+    """
+    Write the plain xml files of net_file to prefix + type and return prefix.
+    All plain types are written, the edge types file is empty if the network
+    defines no edge types.
+    """
+    info = collect(net_file)
+    outputs = {plain_type: open(prefix + plain_type, "w", encoding="utf-8") for plain_type in ROOTS}
+    try:
+        elements = iter_top_level(net_file)
+        version = next(elements).get("version")
+        for plain_type, out in outputs.items():
+            root, schema = ROOTS[plain_type]
+            out.write('<?xml version="1.0" encoding="UTF-8"?>\n\n')
+            out.write('<%s%s xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+                      'xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/%s">\n' % (
+                          root, attr_string([("version", version)]), schema))
+
+        for elem in elements:
+            if elem.tag == "location":
+                write_copy(outputs[TYPE_NODES], elem)
+                if info.has_shapes:
+                    # edge shapes are only meaningful together with the location
+                    write_copy(outputs[TYPE_EDGES], elem)
+            elif elem.tag == "junction":
+                write_node(outputs[TYPE_NODES], elem, info)
+            elif elem.tag == "edge":
+                if is_normal_edge(elem):
+                    write_edge(outputs[TYPE_EDGES], elem)
+                elif elem.get("function") == "crossing":
+                    write_crossing(outputs[TYPE_CONNECTIONS], elem, info)
+            elif elem.tag == "roundabout":
+                write_copy(outputs[TYPE_EDGES], elem)
+            elif elem.tag == "connection":
+                write_connection(outputs, elem, info)
+            elif elem.tag == "prohibition":
+                write_copy(outputs[TYPE_CONNECTIONS], elem)
+            elif elem.tag == "tlLogic":
+                write_copy(outputs[TYPE_TLLOGICS], elem)
+            elif elem.tag == "type":
+                write_copy(outputs[TYPE_EDGETYPES], elem)
+
+        for edge in info.unconnected:
+            write_element(outputs[TYPE_CONNECTIONS], "connection", [("from", edge)])
+
+        for plain_type, out in outputs.items():
+            out.write("</%s>\n" % ROOTS[plain_type][0])
+    finally:
+        for out in outputs.values():
+            out.close()
+    return prefix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a .net.xml network into plain xml files without netconvert.")
+    parser.add_argument("network", help="SUMO .net.xml network")
+    parser.add_argument("prefix", help="Prefix of the written plain xml files")
+    args = parser.parse_args()
+    convert(args.network, args.prefix)
+
+
+if __name__ == "__main__":
+    main()
@@ -27,22 +27,36 @@ from __future__ import print_function
 import sys
 import os
 import codecs
+import hashlib
+import heapq
+import pickle
+import shutil
+import sqlite3
+import tempfile
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
-from xml.dom import pulldom
-from xml.dom import Node
+try:
+    from lxml.etree import fromstring, iterparse, tostring
+except ImportError:
+    from xml.etree.ElementTree import fromstring, iterparse, tostring
 from subprocess import call
-from collections import defaultdict
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from itertools import chain, groupby
+from operator import itemgetter
+try:
+    from sys import intern
+except ImportError:
+    pass  # builtin in python2
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
 import sumolib  # noqa
-from sumolib.datastructures.OrderedMultiSet import OrderedMultiSet  # noqa
 from sumolib.options import ArgumentParser  # noqa
 
 
-def parse_args():
+def parse_args(args=None):
     optParser = ArgumentParser()
     optParser.add_option("source", category="input", type=optParser.net_file,
                          help="original network")
@@ -70,11 +84,64 @@ def parse_args():
                          help="Write shape files for created, deleted and changed elements")
     optParser.add_option("-g", "--plain-geo", category="output", action="store_true", default=False,
                          help="Write geo coordinates instead of network coordinates")
-    options = optParser.parse_args()
+    optParser.add_option("--cache-dir",
+                         help="reuse plain-xml exports of unchanged networks stored in this directory")
+    optParser.add_option("--cache-size", type=int, default=10240,
+                         help="maximum size of the plain-xml cache in MB")
+    optParser.add_option("-j", "--jobs", type=int, default=1,
+                         help="number of file types to compare in parallel processes")
+    optParser.add_option("--add-target", nargs=2, action="append", metavar=("DEST", "OUTPREFIX"),
+                         help="also compare source with the modified network DEST writing the diff files "
+                         "to OUTPREFIX, the source is only read once (may be repeated)")
+    optParser.add_option("--native", action="store_true", default=False,
+                         help="convert the networks to plain-xml in python instead of calling netconvert")
+    optParser.add_option("--spill-dir",
+                         help="keep the attributes of the compared elements in temporary databases in this "
+                         "directory instead of memory (their ids are still kept in memory)")
+    optParser.add_option("--geom-tolerance", type=float,
+                         help="treat node positions and shape points at most this (euclidean) distance "
+                         "apart as unchanged")
+    optParser.add_option("--manifest-dir",
+                         help="store per-element hashes of the compared files in this directory "
+                         "and only compare the elements whose hashes differ")
+    optParser.add_option("--merge", action="store_true", default=False,
+                         help="compare the files in a single pass over their elements sorted by id "
+                         "(unsorted files are sorted in temporary files)")
+    options = optParser.parse_args(args)
     if options.use_prefix and options.direct:
         optParser.error(
             "Options --use-prefix and --direct are mutually exclusive")
 
+    if options.cache_dir and (options.use_prefix or options.direct):
+        optParser.error(
+            "Option --cache-dir only applies when comparing networks")
+
+    if options.native:
+        if options.use_prefix or options.direct:
+            optParser.error(
+                "Option --native only applies when comparing networks")
+        if options.cache_dir:
+            optParser.error(
+                "Options --native and --cache-dir are mutually exclusive")
+        if options.plain_geo:
+            optParser.error(
+                "Options --native and --plain-geo are mutually exclusive")
+
+    if options.merge and options.patch_on_import:
+        optParser.error(
+            "Options --merge and --patch-on-import are mutually exclusive")
+
+    if options.manifest_dir:
+        if options.merge:
+            optParser.error(
+                "Options --manifest-dir and --merge are mutually exclusive")
+        if options.patch_on_import:
+            optParser.error(
+                "Options --manifest-dir and --patch-on-import are mutually exclusive")
+        if options.copy:
+            optParser.error(
+                "Options --manifest-dir and --copy are mutually exclusive")
+
     if options.write_shapes:
         if options.direct:
             optParser.error(
@@ -86,6 +153,31 @@ def parse_args():
     return options
 
 
+def make_options(source, dest, outprefix, **kwargs):
+    """
+    Return the options for calling main() from python.
+    Keyword arguments override the defaults and use the option destinations
+    (e.g. use_prefix=True for --use-prefix). They are passed to parse_args as
+    command line options, so invalid combinations are rejected the same way.
+    """
+    defaults = parse_args([source, dest, outprefix])
+    args = []
+    for name, value in kwargs.items():
+        if not hasattr(defaults, name):
+            raise ValueError("Unknown netdiff option '%s'" % name)
+        option = "--" + name.replace("_", "-")
+        if value is True:
+            args.append(option)
+        elif value is False or value is None:
+            continue
+        elif name == "add_target":
+            for target in value:
+                args += [option] + list(target)
+        else:
+            args += [option, str(value)]
+    return parse_args(args + [source, dest, outprefix])
+
+
 # CONSTANTS
 INDENT = 4
 
@@ -170,12 +262,391 @@ DEFAULT_VALUES['fringe'] = "default"
 
 IGNORE_TAGS = set([TAG_LOCATION])
 
+# attributes holding shapes and the coordinates of a position, compared with
+# --geom-tolerance by the distance of their points
+GEOM_ATTRS = set(['shape', 'outlineShape'])
+POSITION_ATTRS = ('x', 'y', 'z')
+
+# elements drawn with --write-shapes
+SHAPE_TAGS = set([TAG_EDGE, TAG_NODE])
+
+# (tag, id) lists of an AttributeStore after comparison, see getPartition
+# reorderTLL tells whether tlLogics must be written first (CAVEAT8)
+Partition = namedtuple('Partition', ['created', 'deleted', 'changed', 'reorderTLL'])
+
+# names-tuples shared by all AttributeStores, only a single instance of each
+# tuple is kept to conserve memory. Cleared at the end of each main run
+ATTR_NAMES = {}
+
+# attribute values up to this length are interned unless they are coordinates,
+# short values (types, priorities, speeds, edge ids) repeat across many elements
+INTERN_MAX_LENGTH = 64
+
+# flags of the handles of an IdTable: stored from the source, not found in the
+# destination yet and created in the destination
+STORED = 1
+DELETED = 2
+CREATED = 4
+
+# number of records of a SpilledRecords kept in memory
+SPILL_CACHE_SIZE = 50000
+# number of least recently used records evicted at once
+SPILL_BATCH_SIZE = 5000
+
+# number of elements sorted in memory for one run of the external sort of --merge
+SORT_RUN_SIZE = 100000
+
+# per-element hashes of a file for --manifest-dir
+# header is (root, schema, version) as returned by handle_children, digests
+# maps the join_key of (tag, id) to the hash of all elements with that id and
+# root hashes all digests in file order
+Manifest = namedtuple('Manifest', ['header', 'root', 'digests'])
+
+# temporary files of MergeDiff receiving the written elements
+MERGE_SECTIONS = ('copied', 'deleted', 'created', 'createdTLL', 'changed', 'changedTLL')
+
+
+# insertion ordered multiset with the interface of sumolib's OrderedMultiSet
+# entries are stored under integer handles in an ordered dict instead of
+# linked list nodes and deques, which takes a fraction of the memory
+class OrderedMultiSet(object):
+    __slots__ = ('entries', 'handles', 'next_handle')
+
+    def __init__(self, iterable=None):
+        # dict from handle to key in insertion order
+        self.entries = {}
+        # dict from key to its handle or to the list of handles of its instances
+        self.handles = {}
+        self.next_handle = 0
+        if iterable is not None:
+            for key in iterable:
+                self.add(key)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.handles
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def add(self, key):
+        handle = self.next_handle
+        self.next_handle += 1
+        self.entries[handle] = key
+        known = self.handles.get(key)
+        if known is None:
+            self.handles[key] = handle
+        elif isinstance(known, list):
+            known.append(handle)
+        else:
+            self.handles[key] = [known, handle]
+
+    # removes the oldest instance of key
+    def discard(self, key):
+        known = self.handles.get(key)
+        if known is None:
+            return
+        if isinstance(known, list):
+            handle = known.pop(0)
+            if len(known) == 1:
+                self.handles[key] = known[0]
+        else:
+            handle = known
+            del self.handles[key]
+        del self.entries[handle]
+
+    def remove(self, key):
+        if key not in self.handles:
+            raise KeyError(key)
+        self.discard(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.handles.clear()
+
+    def __sub__(self, other):
+        result = OrderedMultiSet(self)
+        for key in other:
+            result.discard(key)
+        return result
+
+    def __or__(self, other):
+        result = OrderedMultiSet(self)
+        for key in other:
+            result.add(key)
+        return result
+
+
+# returns (tag, id) as a single string
+def join_key(tagid):
+    tag, id = tagid
+    return "\x00".join((tag,) + id)
+
+
+# list-like store from the handles of an IdTable to (names, values, children)
+# or None kept in an sqlite database for --spill-dir
+# the most recently used records are cached and written back in batches when
+# evicted. Records with children are always written back because the children
+# are modified in place
+# only the records are spilled, the handles and flags of the IdTable stay in
+# memory so its memory remains proportional to the number of ids
+class SpilledRecords(object):
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.db = sqlite3.connect(dbfile)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE records (handle INTEGER PRIMARY KEY, value BLOB)")
+        # dict from handle to [record, dirty] in the order of use
+        self.cache = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, record):
+        self.size += 1
+        if record is not None:
+            self[self.size - 1] = record
+
+    def __getitem__(self, handle):
+        if not 0 <= handle < self.size:
+            raise IndexError(handle)
+        entry = self.cache.get(handle)
+        if entry is not None:
+            self.cache.move_to_end(handle)
+            return entry[0]
+        row = self.db.execute("SELECT value FROM records WHERE handle=?", (handle,)).fetchone()
+        if row is None:
+            return None
+        names, values, children = pickle.loads(row[0])
+        record = (ATTR_NAMES.setdefault(names, names), values, children)
+        self.cache[handle] = [record, children is not None]
+        self.evict()
+        return record
+
+    def __setitem__(self, handle, record):
+        if not 0 <= handle < self.size:
+            raise IndexError(handle)
+        entry = self.cache.get(handle)
+        if entry is None:
+            self.cache[handle] = [record, True]
+            self.evict()
+        else:
+            entry[0] = record
+            entry[1] = True
+            self.cache.move_to_end(handle)
+
+    def writeBack(self, entries):
+        entries = [(handle, record) for handle, (record, dirty) in entries if dirty]
+        self.db.executemany("INSERT OR REPLACE INTO records (handle, value) VALUES (?, ?)",
+                            [(handle, pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+                             for handle, record in entries if record is not None])
+        self.db.executemany("DELETE FROM records WHERE handle=?",
+                            [(handle,) for handle, record in entries if record is None])
+
+    # writes back the least recently used records when the cache is full
+    def evict(self):
+        if len(self.cache) > SPILL_CACHE_SIZE:
+            self.writeBack([self.cache.popitem(last=False) for i in range(SPILL_BATCH_SIZE)])
+
+    # writes back all cached records and keeps them cached
+    def flush(self):
+        self.writeBack(self.cache.items())
+        for entry in self.cache.values():
+            if entry[0] is None or entry[0][2] is None:
+                entry[1] = False
+
+    def close(self):
+        self.cache.clear()
+        self.db.close()
+        os.remove(self.dbfile)
+
+
+# the elements with id of an AttributeStore under integer handles shared by
+# its deleted, created and copied ids and its records
+# every stored or created instance of a (tag, id) gets the next handle and
+# flags telling which of the id sequences contain it, so all of them follow the
+# order of the handles. The record (names, values, children) of a (tag, id) is
+# kept once under the handle of its first instance. Instances of a (tag, id)
+# stored several times behave like the OrderedMultiSet of sumolib's netdiff
+class IdTable(object):
+    __slots__ = ('tagids', 'handles', 'extra', 'flags', 'records')
+
+    # records is a list or SpilledRecords
+    def __init__(self, records=None):
+        # list from handle to (tag, id)
+        self.tagids = []
+        # dict from (tag, id) to the handle of its first instance
+        self.handles = {}
+        # dict from (tag, id) to the handles of its further stored instances
+        self.extra = {}
+        # STORED, DELETED and CREATED flags of every handle
+        self.flags = bytearray()
+        # list or SpilledRecords from handle to the record of a first handle
+        # or None
+        self.records = [] if records is None else records
+
+    def __len__(self):
+        return len(self.tagids)
+
+    # returns the first handle of tagid after adding an instance with flags
+    def add(self, tagid, flags):
+        handle = len(self.tagids)
+        self.tagids.append(tagid)
+        self.flags.append(flags)
+        self.records.append(None)
+        first = self.handles.setdefault(tagid, handle)
+        if first != handle and flags & STORED:
+            self.extra.setdefault(tagid, []).append(handle)
+        return first
+
+    # adds a source element, deleted until it is found in the destination
+    def store(self, tagid, record):
+        self.records[self.add(tagid, STORED | DELETED)] = record
+
+    # adds a destination element not found in the source
+    def create(self, tagid, record):
+        self.records[self.add(tagid, CREATED)] = record
+
+    # returns the first handle of tagid or None
+    def handle(self, tagid):
+        return self.handles.get(tagid)
+
+    # returns the handles of the further stored instances of tagid
+    def extraHandles(self, tagid):
+        return self.extra.get(tagid, ())
+
+    # returns the record of a first handle or None
+    def getRecord(self, handle):
+        return self.records[handle]
+
+    def putRecord(self, handle, record):
+        self.records[handle] = record
+
+    # iterates over the (tag, id) of all handles
+    def allTagids(self):
+        return self.tagids
+
+    # iterates over the (tag, id) and first handle of every element
+    def firstHandles(self):
+        return self.handles.items()
+
+    # returns whether an instance of tagid is deleted
+    def isDeleted(self, tagid):
+        first = self.handle(tagid)
+        if first is None:
+            return False
+        if self.flags[first] & DELETED:
+            return True
+        return any(self.flags[handle] & DELETED for handle in self.extraHandles(tagid))
+
+    # marks the oldest deleted instance of tagid as found in the destination
+    def discard(self, tagid):
+        first = self.handle(tagid)
+        if first is None:
+            return
+        for handle in [first] + list(self.extraHandles(tagid)):
+            if self.flags[handle] & DELETED:
+                self.flags[handle] &= ~DELETED
+                return
+
+    def record(self, tagid):
+        first = self.handle(tagid)
+        record = None if first is None else self.getRecord(first)
+        if record is None:
+            raise KeyError(tagid)
+        return record
+
+    def setRecord(self, tagid, record):
+        self.putRecord(self.handle(tagid), record)
+
+    def delRecord(self, tagid):
+        self.putRecord(self.handle(tagid), None)
+
+    # returns the (tag, id) of the instances with flag in handle order
+    def select(self, flag):
+        return [tagid for tagid, flags in zip(self.allTagids(), self.flags) if flags & flag]
+
+    def deleted(self):
+        return self.select(DELETED)
+
+    def created(self):
+        return self.select(CREATED)
+
+    def copied(self):
+        return self.select(STORED)
+
+    # iterates over the (tag, id) and record of every element with a record
+    # in the order of first insertion like a dict
+    def items(self):
+        for tagid, first in self.firstHandles():
+            record = self.getRecord(first)
+            if record is not None:
+                yield tagid, record
+
+
+# copy-on-write view of an IdTable, which must not change while the view is
+# used. The handles and records of the table are shared, the view only keeps
+# its own flags (one byte per handle), the records it replaced and the
+# instances it added after the handles of the table
+class IdTableView(IdTable):
+    __slots__ = ('base', 'size')
+
+    def __init__(self, base):
+        IdTable.__init__(self, {})
+        self.base = base
+        # number of handles of base
+        self.size = len(base)
+        self.flags = bytearray(base.flags)
+
+    def __len__(self):
+        return self.size + len(self.tagids)
+
+    def add(self, tagid, flags):
+        handle = len(self)
+        self.tagids.append(tagid)
+        self.flags.append(flags)
+        first = self.handle(tagid)
+        if first is None:
+            first = self.handles[tagid] = handle
+        elif flags & STORED:
+            if tagid not in self.extra:
+                self.extra[tagid] = list(self.base.extraHandles(tagid))
+            self.extra[tagid].append(handle)
+        return first
+
+    def handle(self, tagid):
+        first = self.base.handle(tagid)
+        return self.handles.get(tagid) if first is None else first
+
+    def extraHandles(self, tagid):
+        extra = self.extra.get(tagid)
+        return self.base.extraHandles(tagid) if extra is None else extra
+
+    def getRecord(self, handle):
+        if handle in self.records:
+            return self.records[handle]
+        return self.base.getRecord(handle) if handle < self.size else None
+
+    def allTagids(self):
+        return chain(self.base.allTagids(), self.tagids)
+
+    def firstHandles(self):
+        return chain(self.base.firstHandles(), self.handles.items())
+
 
 # stores attributes for later comparison
 class AttributeStore:
+    __slots__ = ('type', 'copy_tags', 'level', 'attrnames', 'ids', 'deleted_by_from', 'partition',
+                 'idless_deleted', 'idless_created', 'idless_copied', 'cow')
     patchImport = False
+    geomTolerance = None
 
-    def __init__(self, type, copy_tags, level=1):
+    def __init__(self, type, copy_tags, level=1, spill_dir=None):
         # xml type being parsed
         self.type = type
         # tag names to copy even if unchanged
@@ -183,66 +654,107 @@ class AttributeStore:
         # indent level
         self.level = level
         # dict of names-tuples
-        self.attrnames = {}
-        # sets of (tag, id) preserve order to avoid dangling references during
-        # loading
-        self.ids_deleted = OrderedMultiSet()
-        self.ids_created = OrderedMultiSet()
-        self.ids_copied = OrderedMultiSet()
-        # dict from (tag, id) to (names, values, children)
-        self.id_attrs = {}
+        self.attrnames = ATTR_NAMES
+        # IdTable of the deleted, created and copied (tag, id) and their
+        # (names, values, children), in order to avoid dangling references
+        # during loading. The records are kept in SpilledRecords in a temporary
+        # file of spill_dir
+        if spill_dir is None:
+            self.ids = IdTable()
+        else:
+            fd, dbfile = tempfile.mkstemp(prefix="netdiff", suffix=type + ".db", dir=spill_dir)
+            os.close(fd)
+            self.ids = IdTable(SpilledRecords(dbfile))
+        # dict from first id component (from-edge for connections) to the
+        # deleted tagids, built on first use with patchImport
+        self.deleted_by_from = None
+        # Partition computed on first use, reset whenever the ids change
+        self.partition = None
         # dict from tag to (names, values)-sets, need to preserve order
         # (CAVEAT5)
         self.idless_deleted = defaultdict(OrderedMultiSet)
         self.idless_created = defaultdict(OrderedMultiSet)
         self.idless_copied = defaultdict(OrderedMultiSet)
+        # whether the children are shared with the store this is a view of
+        self.cow = False
 
     def __str__(self):
         return ("AttributeStore(level=%s, attrnames=%s, id_attrs:%s)" % (
             self.level, self.attrnames,
             ''.join(["\n%s%s: n=%s, v=%s, c=%s" % ('  ' * self.level, k, n, v, c)
-                     for k, (n, v, c) in self.id_attrs.items()])))
-
-    # getAttribute returns "" if not present
+                     for k, (n, v, c) in self.ids.items()])))
+
+    # the shared attrnames and the indices are not pickled with the children
+    # of SpilledRecords
+    def __getstate__(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__
+                    if name not in ('attrnames', 'deleted_by_from', 'partition'))
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.attrnames = ATTR_NAMES
+        self.deleted_by_from = None
+        self.partition = None
+
+    # returns a copy of this store which can be compared without modifying
+    # this store. The ids and records are shared with this store through an
+    # IdTableView, children are shared until they are compared (copy-on-write)
+    def view(self):
+        view = AttributeStore(self.type, self.copy_tags, self.level)
+        view.cow = True
+        view.ids = IdTableView(self.ids)
+        for name in ('idless_deleted', 'idless_created', 'idless_copied'):
+            setattr(view, name, defaultdict(OrderedMultiSet, [
+                (tag, OrderedMultiSet(value_set)) for tag, value_set in getattr(self, name).items()]))
+        return view
+
+    # removes the database of SpilledRecords
+    def close(self):
+        if isinstance(self.ids.records, SpilledRecords):
+            self.ids.records.close()
+            self.ids.records = [None] * len(self.ids)
+
+    # returns None if not present
     def getValue(self, node, name):
-        if node.hasAttribute(name):
-            return node.getAttribute(name)
-        else:
-            return None
+        return node.get(name)
 
     def getNames(self, xmlnode):
-        idattrs = IDATTRS[xmlnode.localName]
-        a = xmlnode.attributes
-        all = [a.item(i).localName for i in range(a.length)]
+        idattrs = IDATTRS[localname(xmlnode.tag)]
+        all = [localname(a) for a in xmlnode.attrib]
         instance = tuple([n for n in all if n not in idattrs])
-        if instance not in self.attrnames:
-            self.attrnames[instance] = instance
         # only store a single instance of this tuple to conserve memory
-        return self.attrnames[instance]
+        return self.attrnames.setdefault(instance, instance)
 
     def getAttrs(self, xmlnode):
         names = self.getNames(xmlnode)
-        values = tuple([self.getValue(xmlnode, a) for a in names])
+        # interned strings are shared between all elements with the same value or id,
+        # coordinates and long values are mostly unique and not interned
+        values = tuple([self.internValue(a, self.getValue(xmlnode, a)) for a in names])
         children = None
-        if any([c.nodeType == Node.ELEMENT_NODE for c in xmlnode.childNodes]):
+        if any(True for c in childElements(xmlnode)):
             children = AttributeStore(
                 self.type, self.copy_tags, self.level + 1)
-        tag = xmlnode.localName
-        id = tuple([xmlnode.getAttribute(a)
-                    for a in IDATTRS[tag] if xmlnode.hasAttribute(a)])
+        tag = intern(localname(xmlnode.tag))
+        id = tuple([intern(xmlnode.get(a))
+                    for a in IDATTRS[tag] if a in xmlnode.attrib])
         return tag, id, children, (names, values, children)
 
+    def internValue(self, name, value):
+        if len(value) > INTERN_MAX_LENGTH or name in GEOM_ATTRS or name in POSITION_ATTRS:
+            return value
+        return intern(value)
+
     def store(self, xmlnode):
         tag, id, children, attrs = self.getAttrs(xmlnode)
         tagid = (tag, id)
         if id != ():
-            self.ids_deleted.add(tagid)
-            self.ids_copied.add(tagid)
-            self.id_attrs[tagid] = attrs
+            self.ids.store(tagid, attrs)
+            self.deleted_by_from = None
+            self.partition = None
             if children:
-                for child in xmlnode.childNodes:
-                    if child.nodeType == Node.ELEMENT_NODE:
-                        children.store(child)
+                for child in childElements(xmlnode):
+                    children.store(child)
         else:
             self.no_children_supported(children, tag)
             self.idless_deleted[tag].add(attrs)
@@ -251,33 +763,29 @@ class AttributeStore:
         tag, id, children, attrs = self.getAttrs(xmlnode)
         oldChildren = None
         tagid = (tag, id)
+        self.partition = None
         if id != ():
             if AttributeStore.patchImport:
                 if self.hasChangedConnection(tagid, attrs):
                     # export all connections from the same edge
-                    fromEdge = id[0]
-                    markChanged = []
-                    for tagid2 in self.ids_deleted:
-                        fromEdge2 = tagid2[1][0]
-                        if fromEdge == fromEdge2:
-                            markChanged.append(tagid2)
-                    for tagid2 in markChanged:
-                        self.ids_deleted.remove(tagid2)
+                    for tagid2 in self.popDeletedFrom(id[0]):
+                        self.ids.discard(tagid2)
                 return
-            if tagid in self.ids_deleted:
-                oldChildren = self.id_attrs[tagid][2]
-                self.ids_deleted.remove(tagid)
-                self.id_attrs[tagid] = self.compareAttrs(
-                    self.id_attrs[tagid], attrs, tag)
+            if self.ids.isDeleted(tagid):
+                sourceAttrs = self.ids.record(tagid)
+                if self.cow and sourceAttrs[2]:
+                    sourceAttrs = sourceAttrs[0:2] + (sourceAttrs[2].view(),)
+                oldChildren = sourceAttrs[2]
+                self.ids.discard(tagid)
+                self.ids.setRecord(tagid, self.compareAttrs(
+                    sourceAttrs, attrs, tag))
             else:
-                self.ids_created.add(tagid)
-                self.id_attrs[tagid] = attrs
+                self.ids.create(tagid, attrs)
 
-            children = self.id_attrs[tagid][2]
+            children = self.ids.record(tagid)[2]
             if children:
-                for child in xmlnode.childNodes:
-                    if child.nodeType == Node.ELEMENT_NODE:
-                        children.compare(child)
+                for child in childElements(xmlnode):
+                    children.compare(child)
                 if tag == TAG_TLL or tag in self.copy_tags:  # see CAVEAT2
                     child_strings = StringIO()
                     children.writeDeleted(child_strings)
@@ -288,30 +796,34 @@ class AttributeStore:
                         # there are some changes. Go back and store everything
                         children = AttributeStore(
                             self.type, self.copy_tags, self.level + 1)
-                        for child in xmlnode.childNodes:
-                            if child.nodeType == Node.ELEMENT_NODE:
-                                children.compare(child)
-                        self.id_attrs[tagid] = self.id_attrs[
-                            tagid][0:2] + (children,)
+                        for child in childElements(xmlnode):
+                            children.compare(child)
+                        self.ids.setRecord(tagid, self.ids.record(tagid)[0:2] + (children,))
 
             elif tag == TAG_EDGE and oldChildren:
                 # see CAVEAT9
                 children = oldChildren
-                for k, (n, v, c) in oldChildren.id_attrs.items():
+                for k, (n, v, c) in oldChildren.ids.items():
                     if c:
                         deletedNeigh = False
-                        for k2, (n2, v2, c2) in c.id_attrs.items():
+                        for k2, (n2, v2, c2) in c.ids.items():
                             if k2[0] == TAG_NEIGH:
                                 deletedNeigh = True
                         if deletedNeigh:
                             # print("k2=%s n2=%s v2=%s c2=%s" % (k2, n2, v2, c2))
                             delkey = (TAG_NEIGH, ("",))
-                            children.id_attrs[k][2].id_attrs = {delkey: ([], [], None)}
-                            children.id_attrs[k][2].ids_created.add(delkey)
-                            children.ids_deleted.discard(k)
+                            if children.cow:
+                                children.ids.setRecord(k, (n, v, c.view()))
+                            # the lane only keeps the removal of its neighbor
+                            neighs = children.ids.record(k)[2]
+                            neighs.ids = IdTable()
+                            neighs.ids.create(delkey, ([], [], None))
+                            neighs.partition = None
+                            children.ids.discard(k)
+                            children.partition = None
                         else:
-                            del children.id_attrs[k]
-                self.id_attrs[tagid] = self.id_attrs[tagid][0:2] + (children,)
+                            children.ids.delRecord(k)
+                self.ids.setRecord(tagid, self.ids.record(tagid)[0:2] + (children,))
 
         else:
             self.no_children_supported(children, tag)
@@ -336,33 +848,67 @@ class AttributeStore:
         if schildren and dchildren:
             # trigger compare
             dchildren = schildren
+        samePosition = (self.geomTolerance is not None and
+                        self.positionEqual(dict(zip(snames, svalues)), dict(zip(dnames, dvalues))))
         if snames == dnames:
-            values = tuple([self.diff(tag, n, s, d)
+            values = tuple([self.diff(tag, n, s, d, samePosition)
                             for n, s, d in zip(snames, svalues, dvalues)])
             return snames, values, dchildren
         else:
             sdict = defaultdict(lambda: None, zip(snames, svalues))
             ddict = defaultdict(lambda: None, zip(dnames, dvalues))
             names = tuple(set(snames + dnames))
-            values = tuple([self.diff(tag, n, sdict[n], ddict[n]) for n in names])
+            values = tuple([self.diff(tag, n, sdict[n], ddict[n], samePosition) for n in names])
             return names, values, dchildren
 
-    def diff(self, tag, name, sourceValue, destValue):
+    def diff(self, tag, name, sourceValue, destValue, samePosition=False):
         if (sourceValue == destValue or
                 # CAVEAT7
-                (tag == TAG_EDGE and name == "type")):
+                (tag == TAG_EDGE and name == "type") or
+                (name in POSITION_ATTRS and samePosition and sourceValue is not None and destValue is not None) or
+                (name in GEOM_ATTRS and self.geomEqual(sourceValue, destValue))):
             return None
         elif destValue is None:
             return DEFAULT_VALUES[name]
         else:
             return destValue
 
+    # compares the x, y[, z] attributes given in both elements as one point with
+    # geomTolerance
+    def positionEqual(self, sourceAttrs, destAttrs):
+        names = [name for name in POSITION_ATTRS if name in sourceAttrs and name in destAttrs]
+        if not names:
+            return False
+        return self.geomEqual(','.join([sourceAttrs[name] for name in names]),
+                              ','.join([destAttrs[name] for name in names]))
+
+    # compares coordinates or shapes with geomTolerance, the points must not be
+    # further apart than geomTolerance
+    def geomEqual(self, sourceValue, destValue):
+        if self.geomTolerance is None or sourceValue is None or destValue is None:
+            return False
+        # shapes are "x,y[,z] x,y[,z] ..."
+        source = [pos.split(',') for pos in sourceValue.split()]
+        dest = [pos.split(',') for pos in destValue.split()]
+        if len(source) != len(dest):
+            return False
+        try:
+            for spos, dpos in zip(source, dest):
+                if len(spos) != len(dpos):
+                    return False
+                distance2 = sum([(float(s) - float(d)) ** 2 for s, d in zip(spos, dpos)])
+                if distance2 > self.geomTolerance ** 2:
+                    return False
+        except ValueError:
+            return False
+        return True
+
     def hasChangedConnection(self, tagid, attrs):
         tag, id = tagid
         if tag != TAG_CONNECTION:
             return False
-        if tagid in self.ids_deleted:
-            names, values, children = self.compareAttrs(self.id_attrs[tagid], attrs, tag)
+        if self.ids.isDeleted(tagid):
+            names, values, children = self.compareAttrs(self.ids.record(tagid), attrs, tag)
             for v in values:
                 if v is not None:
                     return True
@@ -370,17 +916,25 @@ class AttributeStore:
         else:
             return True
 
+    # return and forget the deleted tagids whose id starts with fromEdge
+    def popDeletedFrom(self, fromEdge):
+        if self.deleted_by_from is None:
+            self.deleted_by_from = defaultdict(list)
+            for tagid in self.ids.deleted():
+                self.deleted_by_from[tagid[1][0]].append(tagid)
+        return self.deleted_by_from.pop(fromEdge, [])
+
     def writeDeleted(self, file):
         # data loss if two elements with different tags
         # have the same id
-        for tag, id in self.ids_deleted:
+        for tag, id in self.getPartition().deleted:
             comment_start, comment_end = ("", "")
             additional = ""
             delete_element = DELETE_ELEMENT
 
             if self.type == TYPE_TLLOGICS and tag == TAG_CONNECTION:
                 # see CAVEAT4
-                names, values, children = self.id_attrs[(tag, id)]
+                names, values, children = self.ids.record((tag, id))
                 additional = " " + self.attr_string(names, values)
 
             if tag == TAG_TLL:  # see CAVEAT3
@@ -416,23 +970,31 @@ class AttributeStore:
             self.write_idless(file, value_set, DELETE_ELEMENT)
 
     def writeCreated(self, file, whiteList=None, blackList=None):
-        self.write_tagids(file, self.filterTags(self.ids_created, whiteList, blackList), True)
+        self.write_tagids(file, self.filterTags(self.getPartition().created, whiteList, blackList), True)
         for tag, value_set in self.idless_created.items():
             if ((whiteList is not None and tag not in whiteList)
                     or (blackList is not None and tag in blackList)):
                 continue
             self.write_idless(file, value_set, tag)
 
+    # copied ids without one instance for every deleted or created instance
     def getTagidsChanged(self):
-        return self.ids_copied - (self.ids_deleted | self.ids_created)
+        skip = Counter(self.ids.deleted())
+        skip.update(self.ids.created())
+        changed = []
+        for tagid in self.ids.copied():
+            if skip[tagid] > 0:
+                skip[tagid] -= 1
+            else:
+                changed.append(tagid)
+        return changed
 
     def writeChanged(self, file, whiteList=None, blackList=None):
-        tagids_changed = self.getTagidsChanged()
+        tagids_changed = self.getPartition().changed
         self.write_tagids(file, self.filterTags(tagids_changed, whiteList, blackList), False)
 
     def writeCopies(self, file, copy_tags):
-        tagids_unchanged = self.ids_copied - \
-            (self.ids_deleted | self.ids_created)
+        tagids_unchanged = self.getPartition().changed
         self.write_tagids(file, tagids_unchanged, False)
         for tag, value_set in self.idless_copied.items():
             self.write_idless(file, value_set, tag)
@@ -445,7 +1007,7 @@ class AttributeStore:
     def write_tagids(self, file, tagids, create):
         for tagid in tagids:
             tag, id = tagid
-            names, values, children = self.id_attrs[tagid]
+            names, values, children = self.ids.record(tagid)
             missing = []
             attrs = self.attr_string(names, values, missing)
             child_strings = StringIO()
@@ -475,12 +1037,85 @@ class AttributeStore:
 
     def attr_string(self, names, values, missing=None):
         if missing is not None:
-            missing += [n for n, v in sorted(zip(names, values)) if v is MISSING_DEFAULT]
-        return ' '.join(['%s="%s"' % (n, v) for n, v in sorted(zip(names, values)) if v is not None and v is not MISSING_DEFAULT])  # noqa
+            missing += [n for n, v in sorted(zip(names, values)) if v == MISSING_DEFAULT]
+        return ' '.join(['%s="%s"' % item for item in self.attr_items(names, values)])
 
     def id_string(self, tag, id):
-        idattrs = IDATTRS[tag]
-        return ' '.join(['%s="%s"' % (n, v) for n, v in sorted(zip(idattrs, id))])
+        return ' '.join(['%s="%s"' % item for item in self.id_items(tag, id)])
+
+    # the (name, value) pairs written by attr_string
+    def attr_items(self, names, values):
+        return [(n, v) for n, v in sorted(zip(names, values)) if v is not None and v != MISSING_DEFAULT]
+
+    # the (name, value) pairs written by id_string
+    def id_items(self, tag, id):
+        return sorted(zip(IDATTRS[tag], id))
+
+    # the records of the elements written by writeDeleted, see diff_records
+    def deletedRecords(self):
+        records = []
+        for tag, id in self.getPartition().deleted:
+            additional = ()
+            delete_element = DELETE_ELEMENT
+            if tag in (TAG_TLL, TAG_ROUNDABOUT):
+                # written as comments, see CAVEAT3 and writeDeleted
+                continue
+            if self.type == TYPE_CONNECTIONS and tag == TAG_CONNECTION and len(id) == 1:
+                # see CAVEAT10
+                continue
+            if self.type == TYPE_TLLOGICS and tag == TAG_CONNECTION:
+                # see CAVEAT4
+                names, values, children = self.ids.record((tag, id))
+                additional = tuple(self.attr_items(names, values))
+            if tag == TAG_CROSSING:
+                delete_element = tag
+                additional = (('discard', 'true'),)
+            if tag == TAG_NEIGH:
+                delete_element = tag
+                additional = (('lane', ''),)
+            records.append((delete_element, tuple(self.id_items(tag, id)) + additional, (), ()))
+        for value_set in self.idless_deleted.values():
+            records += self.idlessRecords(value_set, DELETE_ELEMENT)
+        return records
+
+    # the records of the elements written by writeCreated
+    def createdRecords(self, whiteList=None, blackList=None):
+        records = self.tagidRecords(self.filterTags(self.getPartition().created, whiteList, blackList), True)
+        for tag, value_set in self.idless_created.items():
+            if ((whiteList is not None and tag not in whiteList)
+                    or (blackList is not None and tag in blackList)):
+                continue
+            records += self.idlessRecords(value_set, tag)
+        return records
+
+    # the records of the elements written by writeChanged
+    def changedRecords(self, whiteList=None, blackList=None):
+        return self.tagidRecords(self.filterTags(self.getPartition().changed, whiteList, blackList), False)
+
+    # the records of the elements written by writeCopies
+    def copiedRecords(self):
+        records = self.tagidRecords(self.getPartition().changed, False)
+        for tag, value_set in self.idless_copied.items():
+            records += self.idlessRecords(value_set, tag)
+        return records
+
+    def idlessRecords(self, attr_set, tag):
+        return [(tag, tuple(self.attr_items(names, values)), (), ()) for names, values, children in attr_set]
+
+    # the records of the elements written by write_tagids
+    def tagidRecords(self, tagids, create):
+        records = []
+        for tagid in tagids:
+            tag, id = tagid
+            names, values, children = self.ids.record(tagid)
+            attrs = self.attr_items(names, values)
+            missing = tuple(n for n, v in sorted(zip(names, values)) if v == MISSING_DEFAULT)
+            child_records = ()
+            if children:
+                child_records = tuple(children.createdRecords() + children.changedRecords())
+            if attrs or child_records or create or tag in self.copy_tags or missing:
+                records.append((tag, tuple(self.id_items(tag, id) + attrs), child_records, missing))
+        return records
 
     def filterTags(self, tagids, whiteList, blackList):
         if whiteList is not None:
@@ -491,238 +1126,749 @@ class AttributeStore:
             return tagids
 
     def reorderTLL(self):
-        for tag, id in self.ids_created:
-            if tag == TAG_CONNECTION:
-                for tag2, id2 in self.getTagidsChanged():
-                    if tag2 == TAG_TLL:
-                        return True
-                return False
-        return False
+        return self.getPartition().reorderTLL
+
+    # returns the Partition of the compared ids, computed once and shared by all writers
+    def getPartition(self):
+        if self.partition is None:
+            created = self.ids.created()
+            changed = self.getTagidsChanged()
+            reorder = (any(tag == TAG_CONNECTION for tag, id in created)
+                       and any(tag == TAG_TLL for tag, id in changed))
+            self.partition = Partition(created, self.ids.deleted(), changed, reorder)
+        return self.partition
 
     def writeCreatedSelection(self, file):
-        for tag, id in self.ids_created:
+        for tag, id in self.getPartition().created:
             # multi-id elements (connections) are not suppored by selection files
             if len(id) == 1:
                 file.write("%s:%s\n" % (tag, str(id[0])))
 
     def writeDeletedSelection(self, file):
-        for tag, id in self.ids_deleted:
+        for tag, id in self.getPartition().deleted:
             # multi-id elements (connections) are not suppored by selection files
             if len(id) == 1:
                 file.write("%s:%s\n" % (tag, str(id[0])))
 
     def writeChangedSelection(self, file):
-        for tag, id in self.getTagidsChanged():
+        for tag, id in self.getPartition().changed:
             # multi-id elements (connections) are not suppored by selection files
             if len(id) == 1:
-                names, values, children = self.id_attrs[(tag, id)]
+                names, values, children = self.ids.record((tag, id))
                 attrs = self.attr_string(names, values)
                 if attrs:
                     file.write("%s:%s\n" % (tag, str(id[0])))
 
-    def writeDeletedShapes(self, file, sourceNet):
-        for tag, id in self.ids_deleted:
-            self.writeShape(file, tag, id, "red", sourceNet, id)
-
-    def writeCreatedShapes(self, file, destNet):
-        for tag, id in self.ids_created:
-            self.writeShape(file, tag, id, "green", destNet, id)
-
-    def writeChangedShapes(self, file, sourceNet, destNet):
-        for tag, id in self.getTagidsChanged():
-            names, values, children = self.id_attrs[(tag, id)]
+    # returns the shapes of the created, deleted and changed elements as
+    # lists of (tag, id, color, fromDest, id2) to be passed to write_shapes
+    def getShapeRequests(self):
+        partition = self.getPartition()
+        created = [(tag, id, "green", True, id)
+                   for tag, id in partition.created if tag in SHAPE_TAGS]
+        deleted = [(tag, id, "red", False, id)
+                   for tag, id in partition.deleted if tag in SHAPE_TAGS]
+        changed = []
+        for tag, id in partition.changed:
+            if tag not in SHAPE_TAGS:
+                continue
+            names, values, children = self.ids.record((tag, id))
             attrs = self.attr_string(names, values)
             if attrs:
-                self.writeShape(file, tag, id, "orange", sourceNet, id)
+                changed.append((tag, id, "orange", False, id))
                 if "shape" in names:
-                    self.writeShape(file, tag, id, "yellow", destNet, id + ("dest",))
-
-    def writeShape(self, file, tag, id, color, net, id2):
-        shape = None
-        fill = False
-        layer = 10
-        if tag == TAG_EDGE:
-            shape = net.getEdge(id[0]).getShape()
-        if tag == TAG_NODE:
-            shape = net.getNode(id[0]).getShape()
-            fill = True
-            layer = 11
-        if shape:
-            shape = ' '.join([','.join(map(lambda x: "%.2f" % x, pos)) for pos in shape])
-            file.write('    <poly id="%s" type="%s" shape="%s" fill="%s" layer="%s" color="%s"/>\n' % (
-                ":".join(id2), tag, shape, fill, layer, color))
-
-
-def create_plain(netfile, netconvert, plain_geo):
+                    changed.append((tag, id, "yellow", True, id + ("dest",)))
+        return created, deleted, changed
+
+
+# diff of two files compared one id at a time for --merge
+# the elements with the same id are compared in their own AttributeStore, so
+# only these are kept in memory. Elements without id are collected in a
+# single AttributeStore. The written elements are collected in temporary
+# files and follow the id order instead of the order of the files
+class MergeDiff(object):
+
+    def __init__(self, type, copy_tags, selectionOutputFiles, withShapes, tempdir=None):
+        self.type = type
+        self.copy_tags = copy_tags
+        self.selectionOutputFiles = selectionOutputFiles
+        # created, deleted and changed shape requests or None
+        self.shapeRequests = ([], [], []) if withShapes else None
+        self.idless = AttributeStore(type, copy_tags)
+        self.sections = dict([(name, tempfile.TemporaryFile('w+', dir=tempdir))
+                              for name in MERGE_SECTIONS])
+        # see AttributeStore.getPartition
+        self.createdConnection = False
+        self.changedTLL = False
+
+    # compares the source and dest elements of one id
+    def add(self, id, sourceNodes, destNodes):
+        if id == ():
+            for xmlnode in sourceNodes:
+                self.idless.store(xmlnode)
+            for xmlnode in destNodes:
+                self.idless.compare(xmlnode)
+            return
+        store = AttributeStore(self.type, self.copy_tags)
+        for xmlnode in sourceNodes:
+            store.store(xmlnode)
+        for xmlnode in destNodes:
+            store.compare(xmlnode)
+        partition = store.getPartition()
+        self.createdConnection |= any(tag == TAG_CONNECTION for tag, id in partition.created)
+        self.changedTLL |= any(tag == TAG_TLL for tag, id in partition.changed)
+
+        if self.copy_tags:
+            store.writeCopies(self.sections['copied'], self.copy_tags)
+        store.writeDeleted(self.sections['deleted'])
+        store.writeCreated(self.sections['created'], blackList=[TAG_TLL])
+        store.writeCreated(self.sections['createdTLL'], whiteList=[TAG_TLL])
+        store.writeChanged(self.sections['changed'], blackList=[TAG_TLL])
+        store.writeChanged(self.sections['changedTLL'], whiteList=[TAG_TLL])
+        if self.selectionOutputFiles:
+            created, deleted, changed = self.selectionOutputFiles
+            store.writeCreatedSelection(created)
+            store.writeDeletedSelection(deleted)
+            store.writeChangedSelection(changed)
+        if self.shapeRequests is not None:
+            for requests, new in zip(self.shapeRequests, store.getShapeRequests()):
+                requests.extend(new)
+
+    def reorderTLL(self):
+        return self.createdConnection and self.changedTLL
+
+    def getShapeRequests(self):
+        return self.shapeRequests
+
+    def copySections(self, file, *names):
+        for name in names:
+            section = self.sections[name]
+            section.seek(0)
+            shutil.copyfileobj(section, file)
+
+    # same layout as write_diff
+    def writeDiff(self, options, diff_file, root, schema, version, copy_tags):
+        store = self.idless
+        sumolib.xml.writeHeader(diff_file, root=root, schemaPath=schema, rootAttrs=version, options=options)
+        if copy_tags:
+            store.write(diff_file, "<!-- Copied Elements -->\n")
+            self.copySections(diff_file, 'copied')
+            store.writeCopies(diff_file, copy_tags)
+        store.write(diff_file, "<!-- Deleted Elements -->\n")
+        self.copySections(diff_file, 'deleted')
+        store.writeDeleted(diff_file)
+
+        if self.reorderTLL():
+            # CAVEAT8
+            store.write(diff_file, "<!-- Created Elements -->\n")
+            self.copySections(diff_file, 'createdTLL')
+            store.writeCreated(diff_file, whiteList=[TAG_TLL])
+            store.write(diff_file, "<!-- Changed Elements -->\n")
+            self.copySections(diff_file, 'changedTLL')
+            store.write(diff_file, "<!-- Created Elements -->\n")
+            self.copySections(diff_file, 'created')
+            store.writeCreated(diff_file, blackList=[TAG_TLL])
+            store.write(diff_file, "<!-- Changed Elements -->\n")
+            self.copySections(diff_file, 'changed')
+        else:
+            store.write(diff_file, "<!-- Created Elements -->\n")
+            self.copySections(diff_file, 'created', 'createdTLL')
+            store.writeCreated(diff_file)
+            store.write(diff_file, "<!-- Changed Elements -->\n")
+            self.copySections(diff_file, 'changed', 'changedTLL')
+        diff_file.write("</%s>\n" % root)
+
+    def close(self):
+        for section in self.sections.values():
+            section.close()
+        self.idless.close()
+
+
+# writes the shape requests of getShapeRequests to the created, deleted and
+# changed shape files, looking up the geometry in the shapes read from the
+# source or dest network (see read_shapes)
+def write_shapes(shapeOutputFiles, shapeRequests, sourceShapes, destShapes):
+    for file, requests in zip(shapeOutputFiles, shapeRequests):
+        for tag, id, color, fromDest, id2 in requests:
+            write_shape(file, tag, id, color, destShapes if fromDest else sourceShapes, id2)
+
+
+def write_shape(file, tag, id, color, shapes, id2):
+    shape = shapes.get((tag, id[0]))
+    fill = False
+    layer = 10
+    if tag == TAG_NODE:
+        fill = True
+        layer = 11
+    if shape:
+        shape = ' '.join([','.join(map(lambda x: "%.2f" % x, pos)) for pos in shape])
+        file.write('    <poly id="%s" type="%s" shape="%s" fill="%s" layer="%s" color="%s"/>\n' % (
+            ":".join(id2), tag, shape, fill, layer, color))
+
+
+# returns the shapes of the requested (tag, id) of nodes and edges in netfile
+# as a dict, reading the network once without building a sumolib net
+# shapes match sumolib's Node.getShape() and Edge.getShape()
+def read_shapes(netfile, wanted):
+    shapes = {}
+
+    def parse_shape(shape):
+        return [tuple(float(c) for c in pos.split(",")[:2]) for pos in shape.split()]
+
+    def handle(xmlnode):
+        tag = localname(xmlnode.tag)
+        id = xmlnode.get("id")
+        if tag == "junction" and (TAG_NODE, id) in wanted:
+            shapes[(TAG_NODE, id)] = parse_shape(xmlnode.get("shape", ""))
+        elif tag == TAG_EDGE and (TAG_EDGE, id) in wanted and xmlnode.get("function") is None:
+            lanes = [parse_shape(lane.get("shape", "")) for lane in childElements(xmlnode)
+                     if localname(lane.tag) == TAG_LANE]
+            if len(lanes) % 2 == 1:
+                shape = lanes[len(lanes) // 2]
+            else:
+                # segment-wise average of all lanes
+                shape = []
+                for i in range(min([len(lane) for lane in lanes] or [0])):
+                    x = 0.
+                    y = 0.
+                    for lane in lanes:
+                        x += lane[i][0]
+                        y += lane[i][1]
+                    shape.append((x / float(len(lanes)), y / float(len(lanes))))
+            shapes[(TAG_EDGE, id)] = shape
+
+    handle_children(netfile, handle)
+    return shapes
+
+
+# returns the Manifest of xmlfile, computing and storing it in manifest_dir
+# unless a manifest of a file with the same content is stored already
+def load_manifest(manifest_dir, xmlfile):
+    # plain_cache.py lives in the parent directory added to sys.path above
+    from plain_cache import file_digest
+    path = os.path.join(manifest_dir, file_digest(xmlfile) + ".manifest")
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    header = [None, None, ""]
+    digests = {}
+    rootDigest = hashlib.blake2b(digest_size=16)
+    for parsenode in iter_children(xmlfile, header):
+        key = join_key(element_key(parsenode))
+        digest = hashlib.blake2b(tostring(parsenode), digest_size=16)
+        if key in digests:
+            # elements sharing an id are hashed together
+            digest.update(digests[key])
+        digests[key] = digest.digest()
+        rootDigest.update(key.encode('utf-8') + b"\x01")
+        rootDigest.update(digests[key])
+    manifest = Manifest(tuple(header), rootDigest.digest(), digests)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=manifest_dir)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(manifest, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    return manifest
+
+
+# returns the set of join_key of (tag, id) whose elements differ between the manifests
+def changed_keys(sourceManifest, destManifest):
+    if sourceManifest.root == destManifest.root:
+        return set()
+    source = sourceManifest.digests
+    dest = destManifest.digests
+    changed = set([key for key, digest in source.items() if dest.get(key) != digest])
+    changed.update([key for key in dest if key not in source])
+    return changed
+
+
+def create_plain(netfile, netconvert, plain_geo, cache=None):
+    plain_options = (["--roundabouts.guess", "false"]
+                     + (["--proj.plain-geo"] if plain_geo else []))
+    if cache is not None:
+        # the plain files stay inside the cache
+        return str(cache.export(netfile, plain_options))
     prefix = netfile[:-8]
     call([netconvert,
           "--sumo-net-file", netfile,
-          "--plain-output-prefix", prefix,
-          "--roundabouts.guess", "false"]
-         + (["--proj.plain-geo"] if plain_geo else []))
+          "--plain-output-prefix", prefix]
+         + plain_options)
     return prefix
 
 
 # creates diff of a flat xml structure
 # (only children of the root element and their attrs are compared)
+# diff is either a file name, an open file object or None to not write it
+# sourceStore optionally holds the source stored by read_source
+# returns the AttributeStore holding the comparison
 def xmldiff(options, source, dest, diff, type, copy_tags, patchImport,
-            selectionOutputFiles, shapeOutputFiles,
-            sourceNet=None, destNet=None):
-    attributeStore = AttributeStore(type, copy_tags)
+            selectionOutputFiles, sourceStore=None):
+    AttributeStore.geomTolerance = options.geom_tolerance
+    if options.merge:
+        return mergediff(options, source, dest, diff, type, copy_tags, selectionOutputFiles)
+    attributeStore = AttributeStore(type, copy_tags, spill_dir=options.spill_dir)
     root = None
     have_source = os.path.isfile(source)
     have_dest = os.path.isfile(dest)
-    if have_source:
-        root, schema, version = handle_children(source, attributeStore.store)
-    if have_dest:
-        if patchImport:
-            # run diff twice to determine edges with changed connections
-            AttributeStore.patchImport = True
-            root, schema, version = handle_children(dest, attributeStore.compare)
-            AttributeStore.patchImport = False
-            root, schema, version = handle_children(dest, attributeStore.compare)
+    if options.manifest_dir and have_source and have_dest:
+        # only elements with differing hashes are compared
+        sourceManifest = load_manifest(options.manifest_dir, source)
+        destManifest = load_manifest(options.manifest_dir, dest)
+        changed = changed_keys(sourceManifest, destManifest)
+        if changed:
+            handle_children(source, lambda xmlnode: (
+                attributeStore.store(xmlnode) if join_key(element_key(xmlnode)) in changed else None))
+            handle_children(dest, lambda xmlnode: (
+                attributeStore.compare(xmlnode) if join_key(element_key(xmlnode)) in changed else None))
+        root, schema, version = destManifest.header
+    else:
+        if sourceStore is not None:
+            attributeStore = sourceStore[0].view()
+            root, schema, version = sourceStore[1]
+        elif have_source:
+            root, schema, version = handle_children(source, attributeStore.store)
+        if have_dest:
+            if patchImport:
+                # run diff twice to determine edges with changed connections
+                AttributeStore.patchImport = True
+                root, schema, version = handle_children(dest, attributeStore.compare)
+                AttributeStore.patchImport = False
+                root, schema, version = handle_children(dest, attributeStore.compare)
+            else:
+                root, schema, version = handle_children(dest, attributeStore.compare)
+
+    if not have_source and not have_dest:
+        print("Skipping %s due to lack of input files." % (diff if isinstance(diff, str) else type))
+    else:
+        if not have_source:
+            print("Source file %s is missing. Assuming all elements are created." % source)
+        elif not have_dest:
+            print("Dest file %s is missing. Assuming all elements are deleted." % dest)
+
+        if hasattr(diff, 'write'):
+            write_diff(options, attributeStore, diff, root, schema, version, copy_tags)
+        elif diff is not None:
+            with codecs.open(diff, 'w', 'utf-8') as diff_file:
+                write_diff(options, attributeStore, diff_file, root, schema, version, copy_tags)
+
+        if selectionOutputFiles:
+            created, deleted, changed = selectionOutputFiles
+            attributeStore.writeCreatedSelection(created)
+            attributeStore.writeDeletedSelection(deleted)
+            attributeStore.writeChangedSelection(changed)
+    return attributeStore
+
+
+# creates the diff of xmldiff with a merge-join of the elements of source and
+# dest sorted by (tag, id)
+# returns the MergeDiff holding the comparison
+def mergediff(options, source, dest, diff, type, copy_tags, selectionOutputFiles):
+    mergeDiff = MergeDiff(type, copy_tags, selectionOutputFiles, options.write_shapes, options.spill_dir)
+    have_source = os.path.isfile(source)
+    have_dest = os.path.isfile(dest)
+    sourceHeader = [None, None, ""]
+    destHeader = [None, None, ""]
+    sourceGroups = iter_groups(source, sourceHeader, options.spill_dir) if have_source else iter([])
+    destGroups = iter_groups(dest, destHeader, options.spill_dir) if have_dest else iter([])
+    sourceGroup = next(sourceGroups, None)
+    destGroup = next(destGroups, None)
+    while sourceGroup is not None or destGroup is not None:
+        if destGroup is None or (sourceGroup is not None and sourceGroup[0] < destGroup[0]):
+            mergeDiff.add(sourceGroup[0][1], sourceGroup[1], [])
+            sourceGroup = next(sourceGroups, None)
+        elif sourceGroup is None or destGroup[0] < sourceGroup[0]:
+            mergeDiff.add(destGroup[0][1], [], destGroup[1])
+            destGroup = next(destGroups, None)
         else:
-            root, schema, version = handle_children(dest, attributeStore.compare)
+            mergeDiff.add(sourceGroup[0][1], sourceGroup[1], destGroup[1])
+            sourceGroup = next(sourceGroups, None)
+            destGroup = next(destGroups, None)
+    root, schema, version = destHeader if have_dest else sourceHeader
 
     if not have_source and not have_dest:
-        print("Skipping %s due to lack of input files." % diff)
+        print("Skipping %s due to lack of input files." % (diff if isinstance(diff, str) else type))
     else:
         if not have_source:
             print("Source file %s is missing. Assuming all elements are created." % source)
         elif not have_dest:
             print("Dest file %s is missing. Assuming all elements are deleted." % dest)
 
-        with codecs.open(diff, 'w', 'utf-8') as diff_file:
-            sumolib.xml.writeHeader(diff_file, root=root, schemaPath=schema, rootAttrs=version, options=options)
-            if copy_tags:
-                attributeStore.write(diff_file, "<!-- Copied Elements -->\n")
-                attributeStore.writeCopies(diff_file, copy_tags)
-            attributeStore.write(diff_file, "<!-- Deleted Elements -->\n")
-            attributeStore.writeDeleted(diff_file)
-
-            if attributeStore.reorderTLL():
-                # CAVEAT8
-                attributeStore.write(diff_file, "<!-- Created Elements -->\n")
-                attributeStore.writeCreated(diff_file, whiteList=[TAG_TLL])
-                attributeStore.write(diff_file, "<!-- Changed Elements -->\n")
-                attributeStore.writeChanged(diff_file, whiteList=[TAG_TLL])
-                attributeStore.write(diff_file, "<!-- Created Elements -->\n")
-                attributeStore.writeCreated(diff_file, blackList=[TAG_TLL])
-                attributeStore.write(diff_file, "<!-- Changed Elements -->\n")
-                attributeStore.writeChanged(diff_file, blackList=[TAG_TLL])
-            else:
-                attributeStore.write(diff_file, "<!-- Created Elements -->\n")
-                attributeStore.writeCreated(diff_file)
-                attributeStore.write(diff_file, "<!-- Changed Elements -->\n")
-                attributeStore.writeChanged(diff_file)
-            diff_file.write("</%s>\n" % root)
-
-            if selectionOutputFiles:
-                created, deleted, changed = selectionOutputFiles
-                attributeStore.writeCreatedSelection(created)
-                attributeStore.writeDeletedSelection(deleted)
-                attributeStore.writeChangedSelection(changed)
-            if shapeOutputFiles:
-                created, deleted, changed = shapeOutputFiles
-                attributeStore.writeCreatedShapes(created, destNet)
-                attributeStore.writeDeletedShapes(deleted, sourceNet)
-                attributeStore.writeChangedShapes(changed, sourceNet, destNet)
+        if hasattr(diff, 'write'):
+            mergeDiff.writeDiff(options, diff, root, schema, version, copy_tags)
+        else:
+            with codecs.open(diff, 'w', 'utf-8') as diff_file:
+                mergeDiff.writeDiff(options, diff_file, root, schema, version, copy_tags)
+    return mergeDiff
+
+
+# stores source once for comparing it with several dest files
+# returns (AttributeStore, header) to be passed to xmldiff
+def read_source(source, type, copy_tags):
+    attributeStore = AttributeStore(type, copy_tags)
+    return attributeStore, handle_children(source, attributeStore.store)
+
+
+# compares one file type of source with the dest file of every target
+# targets is a list of (dest, diff, selectionOutputFiles)
+# each dest is compared with a view of the source which is read only once
+# (except for --merge, --manifest-dir and --spill-dir)
+# returns a list of (AttributeStore, shape requests, diff records) per target,
+# the AttributeStores of all but the first target are dropped after writing.
+# The diff_records of the first target are only returned with withRecords
+def xmldiff_targets(options, source, targets, type, copy_tags, withRecords=False):
+    sourceStore = None
+    if (len(targets) > 1 and os.path.isfile(source)
+            and not (options.merge or options.manifest_dir or options.spill_dir)):
+        sourceStore = read_source(source, type, copy_tags)
+    results = []
+    for dest, diff, selectionOutputFiles in targets:
+        attributeStore = xmldiff(options, source, dest, diff, type, copy_tags,
+                                 options.patch_on_import, selectionOutputFiles, sourceStore)
+        shapeRequests = attributeStore.getShapeRequests() if options.write_shapes else None
+        records = diff_records(attributeStore, copy_tags) if withRecords and not results else None
+        attributeStore.close()
+        results.append((attributeStore if not results else None, shapeRequests, records))
+    return results
+
+
+# compares one file type in a worker process
+# targets is a list of (dest, diff), the diff is written to the file diff
+# or returned as text if diff is None
+# returns a list of (diff text or None, selection texts, shape requests,
+# diff records) per target
+def xmldiff_worker(options, source, targets, type, copy_tags, withRecords=False):
+    diff_texts = [StringIO() if diff is None else diff for dest, diff in targets]
+    selections = [[StringIO(), StringIO(), StringIO()] if options.write_selections else []
+                  for target in targets]
+    results = xmldiff_targets(options, source,
+                              [(dest, diff_text, files) for (dest, diff), diff_text, files
+                               in zip(targets, diff_texts, selections)],
+                              type, copy_tags, withRecords)
+    return [(diff_text.getvalue() if diff is None else None,
+             [f.getvalue() for f in files], shapeRequests, records)
+            for (dest, diff), diff_text, files, (attributeStore, shapeRequests, records)
+            in zip(targets, diff_texts, selections, results)]
+
+
+# writes the diff collected in attributeStore to the open file diff_file
+def write_diff(options, attributeStore, diff_file, root, schema, version, copy_tags):
+    sumolib.xml.writeHeader(diff_file, root=root, schemaPath=schema, rootAttrs=version, options=options)
+    if copy_tags:
+        attributeStore.write(diff_file, "<!-- Copied Elements -->\n")
+        attributeStore.writeCopies(diff_file, copy_tags)
+    attributeStore.write(diff_file, "<!-- Deleted Elements -->\n")
+    attributeStore.writeDeleted(diff_file)
+
+    if attributeStore.reorderTLL():
+        # CAVEAT8
+        attributeStore.write(diff_file, "<!-- Created Elements -->\n")
+        attributeStore.writeCreated(diff_file, whiteList=[TAG_TLL])
+        attributeStore.write(diff_file, "<!-- Changed Elements -->\n")
+        attributeStore.writeChanged(diff_file, whiteList=[TAG_TLL])
+        attributeStore.write(diff_file, "<!-- Created Elements -->\n")
+        attributeStore.writeCreated(diff_file, blackList=[TAG_TLL])
+        attributeStore.write(diff_file, "<!-- Changed Elements -->\n")
+        attributeStore.writeChanged(diff_file, blackList=[TAG_TLL])
+    else:
+        attributeStore.write(diff_file, "<!-- Created Elements -->\n")
+        attributeStore.writeCreated(diff_file)
+        attributeStore.write(diff_file, "<!-- Changed Elements -->\n")
+        attributeStore.writeChanged(diff_file)
+    diff_file.write("</%s>\n" % root)
+
+
+# returns the elements of the diff collected in attributeStore in the order of
+# write_diff as (tag, attrs, children, missing) records, attrs being the
+# (name, value) pairs of the element, children the records of its children and
+# missing the names of the attributes written as missingAttributes comment.
+# Elements written as comments are left out
+def diff_records(attributeStore, copy_tags):
+    records = []
+    if copy_tags:
+        records += attributeStore.copiedRecords()
+    records += attributeStore.deletedRecords()
+    if attributeStore.reorderTLL():
+        # CAVEAT8
+        records += attributeStore.createdRecords(whiteList=[TAG_TLL])
+        records += attributeStore.changedRecords(whiteList=[TAG_TLL])
+        records += attributeStore.createdRecords(blackList=[TAG_TLL])
+        records += attributeStore.changedRecords(blackList=[TAG_TLL])
+    else:
+        records += attributeStore.createdRecords()
+        records += attributeStore.changedRecords()
+    return records
+
+
+# strips the namespace from an element or attribute name
+def localname(name):
+    return name.rsplit('}', 1)[-1]
+
+
+# yields the element children of node, skipping comments and processing instructions
+def childElements(node):
+    for child in node:
+        if isinstance(child.tag, str):
+            yield child
 
 
 # calls function handle_parsenode for all children of the root element
 # returns opening and closing tag of the root element
 def handle_children(xmlfile, handle_parsenode):
-    root = None
-    schema = None
-    version = ""
+    header = [None, None, ""]
+    for parsenode in iter_children(xmlfile, header):
+        handle_parsenode(parsenode)
+    return tuple(header)
+
+
+# yields the children of the root element
+# header receives root, schema and version of the root element
+def iter_children(xmlfile, header=None):
     level = 0
+    rootnode = None
     with open(xmlfile, 'rb') as in_xml:
-        xml_doc = pulldom.parse(in_xml)
-        for event, parsenode in xml_doc:
-            if event == pulldom.START_ELEMENT:
-                # print level, parsenode.getAttribute(ID_ATTR)
+        for event, parsenode in iterparse(in_xml, events=("start", "end")):
+            if event == "start":
                 if level == 0:
-                    # since we did not expand root_open contains the closing slash
-                    root = parsenode.localName
-                    if root == "edges":
-                        schema = "edgediff_file.xsd"
-                    elif root == "tlLogics":
-                        schema = "tllogic_file.xsd"
-                    if parsenode.hasAttribute("version"):
-                        version = ' version="%s"' % parsenode.getAttribute("version")
-                    if root not in ("edges", "nodes", "connections", "tlLogics"):
-                        # do not write schema information
-                        version = None
-                if level == 1:
-                    # consumes END_ELEMENT, no level increase
-                    xml_doc.expandNode(parsenode)
-                    handle_parsenode(parsenode)
-                else:
-                    level += 1
-            elif event == pulldom.END_ELEMENT:
+                    rootnode = parsenode
+                    if header is not None:
+                        root = localname(parsenode.tag)
+                        schema = None
+                        version = ""
+                        if root == "edges":
+                            schema = "edgediff_file.xsd"
+                        elif root == "tlLogics":
+                            schema = "tllogic_file.xsd"
+                        if "version" in parsenode.attrib:
+                            version = ' version="%s"' % parsenode.get("version")
+                        if root not in ("edges", "nodes", "connections", "tlLogics"):
+                            # do not write schema information
+                            version = None
+                        header[:] = [root, schema, version]
+                level += 1
+            else:
                 level -= 1
-        return root, schema, version
+                if level == 1:
+                    yield parsenode
+                    # drop the handled subtree to keep memory constant
+                    rootnode.remove(parsenode)
 
 
-# run
-def main(options):
-    copy_tags = options.copy.split(',') if options.copy else []
+# returns the (tag, id) of an element as stored by AttributeStore
+def element_key(xmlnode):
+    tag = localname(xmlnode.tag)
+    return tag, tuple([xmlnode.get(a) for a in IDATTRS[tag] if a in xmlnode.attrib])
+
 
+def is_sorted(xmlfile):
+    last = None
+    for parsenode in iter_children(xmlfile):
+        key = element_key(parsenode)
+        if last is not None and key < last:
+            return False
+        last = key
+    return True
+
+
+# yields ((tag, id), elements) for the children of the root element in
+# (tag, id) order, keeping the file order of elements with the same id
+# unsorted files are sorted with runs of SORT_RUN_SIZE elements in temporary files
+def iter_groups(xmlfile, header, tempdir=None):
+    if is_sorted(xmlfile):
+        pairs = ((element_key(parsenode), parsenode) for parsenode in iter_children(xmlfile, header))
+        for key, group in groupby(pairs, itemgetter(0)):
+            yield key, [parsenode for k, parsenode in group]
+        return
+    runs = []
+    try:
+        run = []
+        for parsenode in iter_children(xmlfile, header):
+            run.append((element_key(parsenode), tostring(parsenode)))
+            if len(run) == SORT_RUN_SIZE:
+                runs.append(write_run(run, tempdir))
+                run = []
+        if run:
+            runs.append(write_run(run, tempdir))
+        del run
+        pairs = heapq.merge(*[read_run(f) for f in runs], key=itemgetter(0))
+        for key, group in groupby(pairs, itemgetter(0)):
+            yield key, [fromstring(text) for k, text in group]
+    finally:
+        for f in runs:
+            f.close()
+
+
+# sorts the (key, text) pairs of run and writes them to a temporary file
+def write_run(run, tempdir):
+    run.sort(key=itemgetter(0))
+    f = tempfile.TemporaryFile(dir=tempdir)
+    for item in run:
+        pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    f.seek(0)
+    return f
+
+
+def read_run(f):
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+
+# opens the selection and shape files of --write-selections and --write-shapes
+# returns the lists of created, deleted and changed selection and shape files
+def open_output_files(options, outprefix):
     selectionOutputFiles = []
     shapeOutputFiles = []
     if options.write_selections:
-        selectionOutputFiles.append(codecs.open(options.outprefix + '.created.sel.txt', 'w', 'utf-8'))
-        selectionOutputFiles.append(codecs.open(options.outprefix + '.deleted.sel.txt', 'w', 'utf-8'))
-        selectionOutputFiles.append(codecs.open(options.outprefix + '.changed.sel.txt', 'w', 'utf-8'))
+        selectionOutputFiles.append(codecs.open(outprefix + '.created.sel.txt', 'w', 'utf-8'))
+        selectionOutputFiles.append(codecs.open(outprefix + '.deleted.sel.txt', 'w', 'utf-8'))
+        selectionOutputFiles.append(codecs.open(outprefix + '.changed.sel.txt', 'w', 'utf-8'))
     if options.write_shapes:
-        shapeOutputFiles.append(codecs.open(options.outprefix + '.created.shape.add.xml', 'w', 'utf-8'))
-        shapeOutputFiles.append(codecs.open(options.outprefix + '.deleted.shape.add.xml', 'w', 'utf-8'))
-        shapeOutputFiles.append(codecs.open(options.outprefix + '.changed.shape.add.xml', 'w', 'utf-8'))
+        shapeOutputFiles.append(codecs.open(outprefix + '.created.shape.add.xml', 'w', 'utf-8'))
+        shapeOutputFiles.append(codecs.open(outprefix + '.deleted.shape.add.xml', 'w', 'utf-8'))
+        shapeOutputFiles.append(codecs.open(outprefix + '.changed.shape.add.xml', 'w', 'utf-8'))
         for f in shapeOutputFiles:
             sumolib.writeXMLHeader(f, "$Id$", "additional", options=options)  # noqa
+    return selectionOutputFiles, shapeOutputFiles
+
 
+# run
+# outputs optionally maps plain types to open files receiving the diffs
+# of the first target instead of outprefix + type, or to None to not write them
+# records optionally receives for each compared type the diff_records of the
+# first target (not supported with --merge)
+# returns a dict from compared type to the AttributeStore of the first target
+# (empty for the file types compared in worker processes with --jobs,
+# the stores are closed with --spill-dir)
+def main(options, outputs=None, records=None):
+    try:
+        return compare_networks(options, outputs, records)
+    finally:
+        # the names-tuples interned during this run are not reused by the next
+        ATTR_NAMES.clear()
+
+
+# compares the networks of options, see main
+def compare_networks(options, outputs=None, records=None):
+    if records is not None and options.merge:
+        raise ValueError("diff records are not available with --merge")
+    copy_tags = options.copy.split(',') if options.copy else []
+    if options.spill_dir and not os.path.isdir(options.spill_dir):
+        os.makedirs(options.spill_dir)
+    if options.manifest_dir and not os.path.isdir(options.manifest_dir):
+        os.makedirs(options.manifest_dir)
+
+    # (dest, outprefix) of every modified network
+    targets = [(options.dest, options.outprefix)] + [tuple(target) for target in options.add_target or []]
+    outputFiles = [open_output_files(options, outprefix) for dest, outprefix in targets]
+    selectionOutputFiles = [selections for selections, shapes in outputFiles]
+    shapeOutputFiles = [shapes for selections, shapes in outputFiles]
+
+    outputs = outputs or {}
+    stores = {}
+    cache = None
     if options.direct:
-        type = '.xml'
-        xmldiff(options,
-                options.source,
-                options.dest,
-                options.outprefix + type,
-                type,
-                copy_tags,
-                options.patch_on_import,
-                selectionOutputFiles,
-                shapeOutputFiles)
+        types = ['.xml']
+        source = options.source
+        dests = [dest for dest, outprefix in targets]
     else:
-        sourceNet = None
-        destNet = None
-        if not options.use_prefix:
+        types = PLAIN_TYPES
+        source = options.source
+        dests = [dest for dest, outprefix in targets]
+        if options.native:
+            # net2plain.py lives next to this file
+            from net2plain import convert
+            source = convert(source, source[:-8])
+            dests = [convert(dest, dest[:-8]) for dest in dests]
+        elif not options.use_prefix:
             netconvert = sumolib.checkBinary("netconvert", options.path)
-            if shapeOutputFiles:
-                sourceNet = sumolib.net.readNet(options.source)
-                destNet = sumolib.net.readNet(options.dest)
-            options.source = create_plain(options.source, netconvert, options.plain_geo)
-            options.dest = create_plain(options.dest, netconvert, options.plain_geo)
-
-        for type in PLAIN_TYPES:
-            xmldiff(options,
-                    options.source + type,
-                    options.dest + type,
-                    options.outprefix + type,
-                    type,
-                    copy_tags,
-                    options.patch_on_import,
-                    selectionOutputFiles,
-                    shapeOutputFiles,
-                    sourceNet, destNet)
-            if options.remove_plain:
-                os.remove(options.source + type)
-                os.remove(options.dest + type)
-
-    for f in selectionOutputFiles:
-        f.close()
-    for f in shapeOutputFiles:
-        f.write("</additional>\n")
-        f.close()
+            if options.cache_dir:
+                # plain_cache.py lives in the parent directory added to sys.path above
+                from plain_cache import PlainCache
+                cache = PlainCache(options.cache_dir, options.cache_size * 1024 * 1024, netconvert)
+            source = create_plain(source, netconvert, options.plain_geo, cache)
+            dests = [create_plain(dest, netconvert, options.plain_geo, cache) for dest in dests]
+
+    def typeFile(prefix, type):
+        return prefix if options.direct else prefix + type
+
+    def diffFile(index, type):
+        if index == 0 and type in outputs:
+            return outputs[type]
+        return targets[index][1] + type
+
+    # shapes are looked up in the networks once all types are compared
+    shapeRequests = [[] for target in targets]
+    if options.jobs > 1:
+        # open files cannot be passed to the workers, their diff is returned as text
+        with ProcessPoolExecutor(max_workers=min(options.jobs, len(types))) as pool:
+            futures = [pool.submit(xmldiff_worker, options,
+                                   typeFile(source, type),
+                                   [(typeFile(dest, type), None if index == 0 and type in outputs
+                                     else targets[index][1] + type)
+                                    for index, dest in enumerate(dests)],
+                                   type,
+                                   copy_tags,
+                                   records is not None)
+                       for type in types]
+            # merge selections and shapes in the order of the sequential run
+            for type, future in zip(types, futures):
+                for index, (diff_text, selections, requests, typeRecords) in enumerate(future.result()):
+                    if diff_text is not None and outputs[type] is not None:
+                        outputs[type].write(diff_text)
+                    if typeRecords is not None:
+                        records[type] = typeRecords
+                    for f, text in zip(selectionOutputFiles[index], selections):
+                        f.write(text)
+                    if requests is not None:
+                        shapeRequests[index].append(requests)
+    else:
+        for type in types:
+            results = xmldiff_targets(options,
+                                      typeFile(source, type),
+                                      [(typeFile(dest, type), diffFile(index, type), selectionOutputFiles[index])
+                                       for index, dest in enumerate(dests)],
+                                      type,
+                                      copy_tags,
+                                      records is not None)
+            stores[type] = results[0][0]
+            if records is not None:
+                records[type] = results[0][2]
+            for index, (attributeStore, requests, typeRecords) in enumerate(results):
+                if requests is not None:
+                    shapeRequests[index].append(requests)
+
+    if options.write_shapes:
+        sourceWanted = set()
+        destWanted = [set() for target in targets]
+        for index, requestsOfTypes in enumerate(shapeRequests):
+            for requests in requestsOfTypes:
+                for kind in requests:
+                    for tag, id, color, fromDest, id2 in kind:
+                        (destWanted[index] if fromDest else sourceWanted).add((tag, id[0]))
+        sourceShapes = read_shapes(options.source, sourceWanted) if sourceWanted else {}
+        for index, (dest, outprefix) in enumerate(targets):
+            destShapes = read_shapes(dest, destWanted[index]) if destWanted[index] else {}
+            for requests in shapeRequests[index]:
+                write_shapes(shapeOutputFiles[index], requests, sourceShapes, destShapes)
+
+    if cache is not None:
+        # the plain files of the cache are no longer read
+        cache.close()
+
+    if options.remove_plain and cache is None and not options.direct:
+        for type in types:
+            for prefix in [source] + dests:
+                # netconvert does not write the edge types of networks without types
+                if os.path.isfile(prefix + type):
+                    os.remove(prefix + type)
+
+    for selections, shapes in outputFiles:
+        for f in selections:
+            f.close()
+        for f in shapes:
+            f.write("</additional>\n")
+            f.close()
+    return stores
 
 
 if __name__ == "__main__":
@@ -2,113 +2,491 @@
 """
 Extract a subnetwork from an original SUMO network based on TAZ edges.
 
+The network is streamed in two passes: the first pass finds the edges,
+nodes, types and traffic lights needed by the TAZ edges, the second pass
+writes them to the output file. Only the selected ids are kept in memory.
+
+With --batch one subnetwork per TAZ is written to the output directory, the
+same two passes serve all TAZ.
+
+With --buffer-hops K the edges within K hops of the TAZ edges are kept as
+well. The edge adjacency needed for this is cached next to the network in
+<network_file>.taz_index.pkl, which replaces the first pass. Building it when
+the network changed is the first pass.
+
+With --by-shape the edges of every TAZ are the edges whose lanes intersect
+its polygon, taken from the TAZ shape attribute (network coordinates) or from
+the features of a GeoJSON file (lon/lat). The lane shapes are cached next to
+the network in <network_file>.shape_index.pkl and searched with a shapely
+STRtree if shapely>=2 is installed. Building the cache when the network changed
+takes one more pass over the network, and GeoJSON features are projected with
+the location read from the start of the network.
+
+With --plain the plain xml files (.nod, .edg, .con, .tll, .typ) of every
+subnetwork are written next to it by net2plain.py, so apply_patch.py
+--plain-subnetwork can diff them without a netconvert export. net2plain.py
+streams every written subnetwork twice, not the network.
+
 Usage:
     python extract_subnet.py <taz_file> <network_file> <output_file>
+    python extract_subnet.py --batch <taz_file> <network_file> <output_dir>
+    python extract_subnet.py --by-shape <taz_or_geojson_file> <network_file> <output_file>
+    python extract_subnet.py --plain <taz_file> <network_file> <output_file>
 
 Example:
     python extract_subnet.py map.taz.xml brussels.net.xml map.net.xml
 """
 
+import argparse
+import json
+import os
+import pickle
 import sys
+from collections import defaultdict
+from contextlib import ExitStack
 from lxml import etree
 
-def main():
+try:
+    import shapely
+    from shapely.geometry import MultiLineString, Polygon
+    from shapely.strtree import STRtree
+    # the predicate of STRtree.query needs shapely 2
+    if int(shapely.__version__.split(".")[0]) < 2:
+        STRtree = None
+except ImportError:
+    STRtree = None
 
-    taz_file = sys.argv[1]      # File containing TAZ zones
-    network_file = sys.argv[2]  # Original SUMO network file
-    output_file = sys.argv[3]   # Output subnetwork file
+XSI = "http://www.w3.org/2001/XMLSchema-instance"
+INDEX_SUFFIX = ".taz_index.pkl"
+SHAPE_INDEX_SUFFIX = ".shape_index.pkl"
+INDEX_VERSION = 2
+
+
+def iter_children(xml_file):
+    """
+    Yield the children of the root element of xml_file one at a time,
+    detached from the tree to keep memory constant.
+    """
+    depth = 0
+    root = None
+    for event, elem in etree.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if depth == 0:
+                root = elem
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                root.remove(elem)
+                yield elem
 
-    # Read TAZ file and collect edges
-    taz_tree = etree.parse(taz_file)
-    taz_root = taz_tree.getroot()
 
-    edges_in_taz = set()
+def read_taz(taz_file):
+    """
+    Return a dict from the id of every TAZ in taz_file to its set of edge ids.
+    """
+    taz_root = etree.parse(taz_file).getroot()
+    taz_edges = {}
     for taz in taz_root.findall("taz"):
         edges = taz.get("edges", "")
-        for edge in edges.split():
-            edges_in_taz.add(edge.strip())
+        taz_edges.setdefault(taz.get("id"), set()).update(edge.strip() for edge in edges.split())
+    return taz_edges
+
+
+def reverse_id(edge_id):
+    # Reverse edge ID (for example : "-123" to "123")
+    return edge_id[1:] if edge_id.startswith("-") else "-" + edge_id
+
+
+def scan_network(network_file, edge_ids=None):
+    """
+    First pass: find the edges of edge_ids (or their reverse) in the network,
+    or all normal edges if edge_ids is None.
+    Return a dict from the found edge ids to (from, to, type) and the list of
+    (from, to, tl) of the controlled connections between these edges.
+    """
+    candidates = None
+    if edge_ids is not None:
+        candidates = set(edge_ids)
+        candidates.update(reverse_id(edge_id) for edge_id in edge_ids)
+    found_edges = {}
+    tl_connections = []
+    for elem in iter_children(network_file):
+        if elem.tag == "edge":
+            edge_id = elem.get("id")
+            # internal edges have no from and to node
+            wanted = elem.get("from") is not None if candidates is None else edge_id in candidates
+            if wanted:
+                found_edges[edge_id] = (elem.get("from"), elem.get("to"), elem.get("type"))
+        elif elem.tag == "connection":
+            if elem.get("tl") and (candidates is None
+                                   or elem.get("from") in candidates and elem.get("to") in candidates):
+                tl_connections.append((elem.get("from"), elem.get("to"), elem.get("tl")))
+    return found_edges, tl_connections
+
+
+def load_cached(network_file, suffix, build):
+    """
+    Return build(network_file), reusing the result cached next to the network
+    in network_file + suffix while its size and modification time are unchanged.
+    """
+    stat = os.stat(network_file)
+    stamp = (INDEX_VERSION, stat.st_size, stat.st_mtime_ns)
+    index_file = network_file + suffix
+    try:
+        with open(index_file, "rb") as f:
+            cached_stamp, data = pickle.load(f)
+        if cached_stamp == stamp:
+            return data
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+        pass
+    data = build(network_file)
+    try:
+        with open(index_file, "wb") as f:
+            pickle.dump((stamp, data), f, pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        print(f"[WARNING] Cannot cache {index_file}: {e}")
+    return data
+
+
+def load_index(network_file):
+    """
+    Return scan_network(network_file) for all edges, cached next to the network.
+    """
+    return load_cached(network_file, INDEX_SUFFIX, scan_network)
+
+
+def parse_shape(shape):
+    return [tuple(float(c) for c in pos.split(",")[:2]) for pos in shape.split()]
+
+
+def read_lane_shapes(network_file):
+    """
+    Return a dict from every normal edge to the list of its lane shapes.
+    """
+    lane_shapes = {}
+    for elem in iter_children(network_file):
+        if elem.tag == "edge" and elem.get("from") is not None:
+            lane_shapes[elem.get("id")] = [parse_shape(lane.get("shape", ""))
+                                           for lane in elem.iter("lane")]
+    return lane_shapes
+
+
+def read_location(network_file):
+    """
+    Return the network offset and the projection parameter of the network.
+    """
+    for elem in iter_children(network_file):
+        if elem.tag == "location":
+            offset = tuple(float(c) for c in elem.get("netOffset", "0,0").split(","))
+            return offset, elem.get("projParameter", "!")
+    return (0., 0.), "!"
+
+
+def read_polygons(taz_file, network_file):
+    """
+    Return a dict from TAZ id to its list of polygons in network coordinates,
+    each polygon a list of rings (exterior first).
+    Read GeoJSON features for .json and .geojson files, the TAZ shapes otherwise.
+    """
+    if not taz_file.endswith((".json", ".geojson")):
+        taz_root = etree.parse(taz_file).getroot()
+        return {taz.get("id"): [[parse_shape(taz.get("shape"))]]
+                for taz in taz_root.findall("taz") if taz.get("shape")}
+
+    offset, proj_parameter = read_location(network_file)
+    if proj_parameter == "!":
+        # the network is not geo-referenced, coordinates are used as they are
+        def convert(lon, lat):
+            return lon, lat
+    else:
+        try:
+            import pyproj
+        except ImportError:
+            sys.exit("[ERROR] pyproj is needed to project the GeoJSON features onto the geo-referenced "
+                     f"network {network_file} (pip install pyproj)")
+        projection = pyproj.Proj(proj_parameter)
+
+        def convert(lon, lat):
+            x, y = projection(lon, lat)
+            return x + offset[0], y + offset[1]
+
+    with open(taz_file) as f:
+        features = json.load(f).get("features", [])
+    taz_polygons = {}
+    for i, feature in enumerate(features):
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+        taz_id = str(feature.get("id", (feature.get("properties") or {}).get("id", i)))
+        taz_polygons.setdefault(taz_id, []).extend(
+            [[[convert(*pos[:2]) for pos in ring] for ring in polygon] for polygon in polygons])
+    return taz_polygons
+
+
+def point_in_ring(x, y, ring):
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
 
-    # Load the tree of the original network file
-    net_tree = etree.parse(network_file)
-    net_root = net_tree.getroot()
 
-    # Collect all nodes (including <node> and <junction>)
-    all_nodes = {node.get("id"): node for node in net_root.findall("node")}
-    all_nodes.update({junc.get("id"): junc for junc in net_root.findall("junction")})
+def segments_cross(p1, p2, q1, q2):
+    def orientation(a, b, c):
+        return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    d1 = orientation(q1, q2, p1)
+    d2 = orientation(q1, q2, p2)
+    d3 = orientation(p1, p2, q1)
+    d4 = orientation(p1, p2, q2)
+    return d1 * d2 <= 0 and d3 * d4 <= 0
 
-    # Collect all edges
-    all_edges = {edge.get("id"): edge for edge in net_root.findall("edge")}
 
+def line_intersects_polygon(line, polygon):
+    """
+    Return whether the polyline line intersects the polygon (list of rings).
+    """
+    exterior = polygon[0]
+    x, y = line[0]
+    if point_in_ring(x, y, exterior) and not any(point_in_ring(x, y, hole) for hole in polygon[1:]):
+        return True
+    for ring in polygon:
+        for q1, q2 in zip(ring, ring[1:] + ring[:1]):
+            for p1, p2 in zip(line, line[1:]):
+                if segments_cross(p1, p2, q1, q2):
+                    return True
+    return False
+
+
+def bounding_box(points):
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def edges_in_polygons(taz_polygons, lane_shapes):
+    """
+    Return a dict from TAZ id to the set of edges whose lanes intersect one of
+    its polygons. Candidates are found with a shapely STRtree if available and
+    with a scan of the lane bounding boxes otherwise.
+    """
+    edge_ids = [edge_id for edge_id, lanes in lane_shapes.items() if any(len(lane) > 1 for lane in lanes)]
+    taz_edges = {}
+    if STRtree is not None:
+        tree = STRtree([MultiLineString([lane for lane in lane_shapes[edge_id] if len(lane) > 1])
+                        for edge_id in edge_ids])
+        for taz_id, polygons in taz_polygons.items():
+            edges = set()
+            for polygon in polygons:
+                hits = tree.query(Polygon(polygon[0], polygon[1:]), predicate="intersects")
+                edges.update(edge_ids[i] for i in hits)
+            taz_edges[taz_id] = edges
+        return taz_edges
+
+    boxes = [bounding_box([pos for lane in lane_shapes[edge_id] for pos in lane]) for edge_id in edge_ids]
+    for taz_id, polygons in taz_polygons.items():
+        edges = set()
+        for polygon in polygons:
+            xmin, ymin, xmax, ymax = bounding_box(polygon[0])
+            for edge_id, box in zip(edge_ids, boxes):
+                if box[0] > xmax or box[2] < xmin or box[1] > ymax or box[3] < ymin:
+                    continue
+                if any(line_intersects_polygon(lane, polygon)
+                       for lane in lane_shapes[edge_id] if len(lane) > 1):
+                    edges.add(edge_id)
+        taz_edges[taz_id] = edges
+    return taz_edges
+
+
+def expand(edges, found_edges, node_edges, hops):
+    """
+    Return edges extended by all edges within hops hops of their end nodes.
+    node_edges maps every node to the edges starting or ending there.
+    """
+    edges = set(edges)
+    frontier = {node for edge_id in edges for node in found_edges[edge_id][:2]}
+    seen_nodes = set(frontier)
+    for _ in range(hops):
+        new_edges = {edge_id for node in frontier for edge_id in node_edges.get(node, ())
+                     if edge_id not in edges}
+        edges.update(new_edges)
+        frontier = {node for edge_id in new_edges for node in found_edges[edge_id][:2]} - seen_nodes
+        seen_nodes.update(frontier)
+    return edges
+
+
+def select(edges_in_taz, found_edges, tl_connections, node_edges=None, hops=0):
+    """
+    Return a dict with the sets of "edges", "nodes", "types" and "tls" of the
+    subnetwork of edges_in_taz, given the results of scan_network.
+    With hops > 0 the edges within hops hops are kept as well (see expand).
+    """
     # Determine which edges and nodes will be used
     used_nodes = set()
-    missing_edges = []
-    updated_edges_in_taz = set()
-
+    kept_edges = set()
     for edge_id in edges_in_taz:
-        edge = all_edges.get(edge_id)
-        if edge is not None:
-            used_nodes.add(edge.get("from"))
-            used_nodes.add(edge.get("to"))
-            updated_edges_in_taz.add(edge_id)
+        if edge_id in found_edges:
+            kept_edges.add(edge_id)
+        elif reverse_id(edge_id) in found_edges:
+            print(f"[INFO] Edge {edge_id} found as reversed '{reverse_id(edge_id)}'")
+            kept_edges.add(reverse_id(edge_id))
         else:
-            # Try the reverse edge ID (for example : "-123" to "123")
-            reverse_id = edge_id[1:] if edge_id.startswith("-") else "-" + edge_id
-            reverse_edge = all_edges.get(reverse_id)
-            if reverse_edge is not None:
-                print(f"[INFO] Edge {edge_id} found as reversed '{reverse_id}'")
-                used_nodes.add(reverse_edge.get("from"))
-                used_nodes.add(reverse_edge.get("to"))
-                updated_edges_in_taz.add(reverse_id)
-            else:
-                print(f"[WARNING] Edge {edge_id} not found in the network")
-                missing_edges.append(edge_id)
-
-    edges_in_taz = updated_edges_in_taz
-
-    # Create a new subnetwork
-    new_net = etree.Element("net", {
-        "version": "1.3",
-        "{http://www.w3.org/2001/XMLSchema-instance}noNamespaceSchemaLocation":
-            "http://sumo.dlr.de/xsd/net_file.xsd"
-    })
-
-    # Add the used nodes
-    for node_id in used_nodes:
-        node = all_nodes.get(node_id)
-        if node is not None:
-            new_net.append(node)
-
-    # Add the used edges
-    for edge_id in edges_in_taz:
-        edge = all_edges.get(edge_id)
-        if edge is not None:
-            new_net.append(edge)
-
-    # Add connections between the edges we kept
-    used_tls_ids = set()
-    for conn in net_root.findall("connection"):
-        if conn.get("from") in edges_in_taz and conn.get("to") in edges_in_taz:
-            new_net.append(conn)
-            if conn.get("tl"):
-                used_tls_ids.add(conn.get("tl"))
-
-    # Add the types used by these edges
-    used_types = {edge.get("type") for edge in new_net.findall("edge") if edge.get("type")}
-    for type_elem in net_root.findall("type"):
-        if type_elem.get("id") in used_types:
-            new_net.append(type_elem)
-
-    # Add the traffic lights we referenced
-    for tl in net_root.findall("tlLogic"):
-        if tl.get("id") in used_tls_ids:
-            new_net.append(tl)
-
-    # Save the output file
-    output_tree = etree.ElementTree(new_net)
-    output_tree.write(output_file, pretty_print=True, xml_declaration=True, encoding="UTF-8")
-
-    print(f"Subnetwork exported to: {output_file}")
+            print(f"[WARNING] Edge {edge_id} not found in the network")
+
+    if hops > 0:
+        kept_edges = expand(kept_edges, found_edges, node_edges, hops)
+
+    used_types = set()
+    for edge_id in kept_edges:
+        from_node, to_node, edge_type = found_edges[edge_id]
+        used_nodes.add(from_node)
+        used_nodes.add(to_node)
+        if edge_type:
+            used_types.add(edge_type)
+
+    # Keep the traffic lights referenced by the connections we keep
+    used_tls_ids = {tl for from_edge, to_edge, tl in tl_connections
+                    if from_edge in kept_edges and to_edge in kept_edges}
+
+    return {"edges": kept_edges, "nodes": used_nodes, "types": used_types, "tls": used_tls_ids}
+
+
+def build_index(selections):
+    """
+    Return a dict from "edges", "nodes", "types" and "tls" to a dict from id
+    to the indices of the selections containing it.
+    """
+    index = {kind: defaultdict(list) for kind in ("edges", "nodes", "types", "tls")}
+    for i, selection in enumerate(selections):
+        for kind, ids in selection.items():
+            for id in ids:
+                index[kind][id].append(i)
+    return index
+
+
+def owners(elem, index):
+    """
+    Return the indices of the subnetworks the network element elem belongs to.
+    """
+    if elem.tag in ("node", "junction"):
+        return index["nodes"].get(elem.get("id"), ())
+    if elem.tag == "edge":
+        return index["edges"].get(elem.get("id"), ())
+    if elem.tag == "connection":
+        from_owners = index["edges"].get(elem.get("from"))
+        to_owners = index["edges"].get(elem.get("to"))
+        if not from_owners or not to_owners:
+            return ()
+        return [i for i in from_owners if i in to_owners]
+    if elem.tag == "type":
+        return index["types"].get(elem.get("id"), ())
+    if elem.tag == "tlLogic":
+        return index["tls"].get(elem.get("id"), ())
+    return ()
+
+
+def write_subnetworks(network_file, selections, output_files):
+    """
+    Second pass: stream every element of network_file to the output files of
+    the selections containing it.
+    """
+    index = build_index(selections)
+    with ExitStack() as stack:
+        writers = []
+        for output_file in output_files:
+            xf = stack.enter_context(etree.xmlfile(output_file, encoding="UTF-8"))
+            xf.write_declaration()
+            stack.enter_context(xf.element("net", {
+                "version": "1.3",
+                "{%s}noNamespaceSchemaLocation" % XSI: "http://sumo.dlr.de/xsd/net_file.xsd"},
+                nsmap={"xsi": XSI}))
+            xf.write("\n")
+            writers.append(xf)
+
+        for elem in iter_children(network_file):
+            indices = owners(elem, index)
+            if indices:
+                # drop the namespace declarations copied from the root
+                etree.cleanup_namespaces(elem)
+                elem.tail = "\n"
+                for i in indices:
+                    writers[i].write("    ")
+                    writers[i].write(elem)
+
+
+def plain_prefix(output_file):
+    """
+    Return the prefix of the plain files written next to output_file.
+    """
+    if output_file.endswith(".net.xml"):
+        return output_file[:-len(".net.xml")]
+    return os.path.splitext(output_file)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract a subnetwork from a SUMO network based on TAZ edges.")
+    parser.add_argument("taz_file", help="File containing TAZ zones")
+    parser.add_argument("network_file", help="Original SUMO network file")
+    parser.add_argument("output", help="Output subnetwork file (output directory with --batch)")
+    parser.add_argument("--batch", action="store_true",
+                        help="Write one subnetwork <taz id>.net.xml per TAZ into the output directory")
+    parser.add_argument("--buffer-hops", type=int, default=0, metavar="K",
+                        help="Also keep the edges within K hops of the TAZ edges")
+    parser.add_argument("--by-shape", action="store_true",
+                        help="Select the edges intersecting the TAZ shapes (or the polygons of a "
+                             ".geojson file) instead of the listed TAZ edges")
+    parser.add_argument("--plain", action="store_true",
+                        help="Also write the plain xml files of every subnetwork next to it "
+                             "(<output>.nod.xml, .edg.xml, .con.xml, .tll.xml, .typ.xml)")
+    args = parser.parse_args()
+    if args.buffer_hops < 0:
+        parser.error("--buffer-hops must not be negative")
+
+    # Read TAZ file and collect edges
+    if args.by_shape:
+        if STRtree is None:
+            print("[INFO] shapely>=2 is not installed, the lanes are searched without a spatial index")
+        lane_shapes = load_cached(args.network_file, SHAPE_INDEX_SUFFIX, read_lane_shapes)
+        taz_edges = edges_in_polygons(read_polygons(args.taz_file, args.network_file), lane_shapes)
+        del lane_shapes
+    else:
+        taz_edges = read_taz(args.taz_file)
+    edges_in_taz = set().union(*taz_edges.values())
+    node_edges = None
+    if args.buffer_hops > 0:
+        found_edges, tl_connections = load_index(args.network_file)
+        node_edges = defaultdict(list)
+        for edge_id, (from_node, to_node, edge_type) in found_edges.items():
+            node_edges[from_node].append(edge_id)
+            node_edges[to_node].append(edge_id)
+    else:
+        found_edges, tl_connections = scan_network(args.network_file, edges_in_taz)
+
+    if args.batch:
+        os.makedirs(args.output, exist_ok=True)
+        selections = []
+        output_files = []
+        for taz_id, edges in taz_edges.items():
+            print(f"[INFO] TAZ {taz_id}")
+            selections.append(select(edges, found_edges, tl_connections, node_edges, args.buffer_hops))
+            output_files.append(os.path.join(args.output, f"{taz_id}.net.xml"))
+        write_subnetworks(args.network_file, selections, output_files)
+        print(f"{len(output_files)} subnetworks exported to: {args.output}")
+    else:
+        selection = select(edges_in_taz, found_edges, tl_connections, node_edges, args.buffer_hops)
+        write_subnetworks(args.network_file, [selection], [args.output])
+        print(f"Subnetwork exported to: {args.output}")
+        output_files = [args.output]
+
+    if args.plain:
+        # net2plain.py lives next to this file
+        from net2plain import convert
+        for output_file in output_files:
+            print(f"[INFO] Plain files written to: {convert(output_file, plain_prefix(output_file))}.*")
 
 if __name__ == "__main__":
     main()
-
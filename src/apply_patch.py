@@ -2,9 +2,36 @@
 import xml.etree.ElementTree as ET
 from pathlib import Path
 import argparse
+import io
+import pickle
+import struct
 import subprocess
 import shutil
 import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from plain_cache import PlainCache
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "additionals"))
+import netdiff  # noqa: E402
+
+# a patch bundle starts with the magic and the version, checked before the
+# pickled diffs are loaded
+BUNDLE_MAGIC = b"PSUMOPB\n"
+BUNDLE_VERSION = 3
+BUNDLE_HEADER = struct.Struct("<I")
+# plain types whose keys are precomputed in a patch bundle, with their element type
+BUNDLE_TYPES = {
+    netdiff.TYPE_NODES: "node",
+    netdiff.TYPE_EDGES: "edge",
+    netdiff.TYPE_CONNECTIONS: "connection",
+    netdiff.TYPE_TLLOGICS: "tll",
+}
+
+# diff of one plain type loaded from a patch bundle: the diff text, the keys to
+# delete and the (key, record) pairs to add or update
+CompiledDiff = namedtuple("CompiledDiff", ["text", "deleted", "changed"])
 
 def clean_lanes(element):
     """
@@ -29,173 +56,835 @@ def clean_lanes(element):
             element.remove(lane)
 
 
-def apply_diff(source_file, diff_file, element_type, temp_folder: Path):
+def element_key(elem, element_type):
     """
-    Apply an XML diff (add / update / delete) to a SUMO file
-    and return the path of the modified file (inside temp_folder).
+    Return the key identifying a top-level element of a SUMO plain file.
+    The traffic light file holds programs and the connections they control.
     """
-    source_tree = ET.parse(source_file)
-    source_root = source_tree.getroot()
-    diff_tree = ET.parse(diff_file)
-    diff_root = diff_tree.getroot()
-
-    def create_index(root, element_type):
-        index = {}
-        for elem in root.findall("./*"):
-            if element_type == "connection":
-                key = (
-                    elem.get("from"),
-                    elem.get("fromLane"),
-                    elem.get("to"),
-                    elem.get("toLane")
-                )
-            else:
-                key = elem.get("id")
-            index[key] = elem
-        return index
+    if element_type == "tll":
+        if elem.get("from") is not None:
+            return ("connection",) + element_key(elem, "connection")
+        return ("tlLogic", elem.get("id"), elem.get("programID"))
+    if element_type == "connection":
+        return (
+            elem.get("from"),
+            elem.get("fromLane"),
+            elem.get("to"),
+            elem.get("toLane")
+        )
+    return elem.get("id")
 
-    source_index = create_index(source_root, element_type)
 
-    # Deletions
-    for delete_elem in diff_root.findall("./delete"):
-        if element_type == "connection":
-            key = (
-                delete_elem.get("from"),
-                delete_elem.get("fromLane"),
-                delete_elem.get("to"),
-                delete_elem.get("toLane")
-            )
+def child_identity(child):
+    """
+    Return the identity of a child element following the netdiff rules
+    (lane by index, neigh by lane, param by key, ...), or None if the
+    child lacks its identity attributes.
+    """
+    values = tuple(child.get(name) for name in netdiff.IDATTRS[child.tag])
+    if None in values:
+        return None
+    return child.tag, values
+
+
+def update_attributes(target, diff_elem):
+    """
+    Copy the attributes of diff_elem to target, removing those netdiff
+    reported as missing (they have no default value to reset them to).
+    """
+    for attr_name, attr_value in diff_elem.attrib.items():
+        if attr_value == netdiff.MISSING_DEFAULT:
+            target.attrib.pop(attr_name, None)
         else:
-            key = delete_elem.get("id")
-        if key in source_index:
-            source_root.remove(source_index[key])
-            source_index.pop(key)
+            target.set(attr_name, attr_value)
 
-    # Add / Update
-    for diff_elem in diff_root.findall("./*"):
-        if diff_elem.tag != "delete" and diff_elem.tag is not ET.Comment:
-            if element_type == "connection":
-                key = (
-                    diff_elem.get("from"),
-                    diff_elem.get("fromLane"),
-                    diff_elem.get("to"),
-                    diff_elem.get("toLane")
-                )
-            else:
-                key = diff_elem.get("id")
-
-            if key in source_index:
-                for attr_name, attr_value in diff_elem.attrib.items():
-                    source_index[key].set(attr_name, attr_value)
-
-                existing_children = [
-                    (child.tag, tuple(child.attrib.items()))
-                    for child in source_index[key]
-                ]
-                for child in diff_elem:
-                    child_signature = (child.tag, tuple(child.attrib.items()))
-                    if child_signature not in existing_children:
-                        source_index[key].append(child)
-
-                if element_type == "edge":
-                    clean_lanes(source_index[key])
+
+def strip_missing(elem):
+    """
+    Remove the missing attribute markers from a diff element added as a whole.
+    """
+    for child in elem.iter():
+        for attr_name in [name for name, value in child.attrib.items() if value == netdiff.MISSING_DEFAULT]:
+            del child.attrib[attr_name]
+
+
+def merge_children(target, diff_elem):
+    """
+    Merge the children of diff_elem into target: children with the same
+    identity are updated in place (recursively), the others are appended.
+    Children without identity are appended unless an identical one exists.
+    """
+    index = {}
+    signatures = set()
+    for child in target:
+        identity = child_identity(child)
+        if identity is not None:
+            index[identity] = child
+        else:
+            signatures.add((child.tag, tuple(child.attrib.items())))
+
+    for child in diff_elem:
+        if child.tag == netdiff.TAG_NEIGH:
+            # a lane has at most one neigh, <neigh lane=""/> removes it
+            for neigh in target.findall(netdiff.TAG_NEIGH):
+                target.remove(neigh)
+                index.pop(child_identity(neigh), None)
+            if child.get("lane") == "":
+                continue
+
+        identity = child_identity(child)
+        if identity is None:
+            child_signature = (child.tag, tuple(child.attrib.items()))
+            if child_signature not in signatures:
+                strip_missing(child)
+                target.append(child)
+                signatures.add(child_signature)
+        elif identity in index:
+            existing = index[identity]
+            update_attributes(existing, child)
+            merge_children(existing, child)
+        else:
+            strip_missing(child)
+            target.append(child)
+            index[identity] = child
+
+
+def merge_element(target, diff_elem, element_type):
+    """
+    Update target in place with the attributes and children of diff_elem.
+    """
+    update_attributes(target, diff_elem)
+
+    if element_type == "tll" and len(diff_elem):
+        # netdiff writes all phases of a changed program (CAVEAT2 of netdiff)
+        for child in list(target):
+            target.remove(child)
+        strip_missing(diff_elem)
+        target.extend(diff_elem)
+        return
+    merge_children(target, diff_elem)
+
+    if element_type == "edge":
+        clean_lanes(target)
+
+
+def mark_missing(root):
+    """
+    Give the attributes listed in the missingAttributes comments netdiff writes
+    after an element the value netdiff.MISSING_DEFAULT, and drop all comments.
+    """
+    for parent in list(root.iter()):
+        previous = parent
+        for child in list(parent):
+            if child.tag is ET.Comment:
+                text = child.text.strip()
+                if text.startswith("missingAttributes:"):
+                    for attr_name in text[len("missingAttributes:"):].strip().split(","):
+                        previous.set(attr_name, netdiff.MISSING_DEFAULT)
+                parent.remove(child)
             else:
-                source_root.append(diff_elem)
-                source_index[key] = diff_elem
-                if element_type == "edge":
-                    clean_lanes(source_index[key])
+                previous = child
 
-    # Save modified file into temp_folder
+
+def read_diff(diff_file, element_type):
+    """
+    Parse a diff file and return the keys to delete and the
+    (key, element) pairs to add or update, in file order.
+    diff_file may also be a CompiledDiff, whose keys are already computed.
+    """
+    if isinstance(diff_file, CompiledDiff):
+        return list(diff_file.deleted), [(key, record_element(record)) for key, record in diff_file.changed]
+    diff_root = ET.parse(diff_file, ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))).getroot()
+    mark_missing(diff_root)
+    deleted = [element_key(elem, element_type) for elem in diff_root.findall("./delete")]
+    changed = [
+        (element_key(elem, element_type), elem)
+        for elem in diff_root.findall("./*")
+        if elem.tag != "delete" and elem.tag is not ET.Comment
+    ]
+    return deleted, changed
+
+
+def element_record(elem):
+    """
+    Convert an element and its children to nested tuples for a patch bundle.
+    """
+    return (elem.tag, tuple(elem.attrib.items()), elem.text, elem.tail,
+            tuple(element_record(child) for child in elem))
+
+
+def record_element(record):
+    """
+    Rebuild the element stored by element_record.
+    """
+    tag, attrib, text, tail, children = record
+    elem = ET.Element(tag, dict(attrib))
+    elem.text = text
+    elem.tail = tail
+    elem.extend(record_element(child) for child in children)
+    return elem
+
+
+def netdiff_record(record, level=1):
+    """
+    Convert a (tag, attrs, children, missing) record of netdiff.diff_records to
+    the record of element_record, indented like the written diff. Missing
+    attributes get the value netdiff.MISSING_DEFAULT, merge_element removes them.
+    """
+    tag, attrs, children, missing = record
+    attrs = tuple(attrs) + tuple((name, netdiff.MISSING_DEFAULT) for name in missing)
+    indent = "\n" + "    " * level
+    children = [netdiff_record(child, level + 1) for child in children]
+    text = None
+    if children:
+        text = indent + "    "
+        children[-1] = children[-1][:3] + (indent,) + children[-1][4:]
+    return tag, attrs, text, indent, tuple(children)
+
+
+def compile_records(text, records, element_type):
+    """
+    Return the CompiledDiff of the diff records netdiff returned for one plain
+    type, keeping the elements as records instead of parsing the diff text.
+    """
+    deleted = []
+    changed = []
+    for record in records:
+        key = element_key(dict(record[1]), element_type)
+        if record[0] == "delete":
+            deleted.append(key)
+        else:
+            changed.append((key, netdiff_record(record)))
+    return CompiledDiff(text, tuple(deleted), tuple(changed))
+
+
+def compile_bundle(diff_texts, bundle_file):
+    """
+    Write the diffs (a dict from plain type to diff text) as a patch bundle
+    holding the diff text and the precomputed delete keys and update records.
+    """
+    diffs = {}
+    for plain_type in netdiff.PLAIN_TYPES:
+        text = diff_texts.get(plain_type, "")
+        deleted, changed = [], []
+        if text and plain_type in BUNDLE_TYPES:
+            deleted, changed = read_diff(io.StringIO(text), BUNDLE_TYPES[plain_type])
+        diffs[plain_type] = (text, tuple(deleted),
+                             tuple((key, element_record(elem)) for key, elem in changed))
+    with open(bundle_file, "wb") as f:
+        f.write(BUNDLE_MAGIC + BUNDLE_HEADER.pack(BUNDLE_VERSION))
+        pickle.dump(diffs, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class BundleUnpickler(pickle.Unpickler):
+    """
+    Unpickler refusing every class and function, a patch bundle only holds
+    dicts, tuples, strings and None.
+    """
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"patch bundles cannot contain {module}.{name}")
+
+
+def load_bundle(bundle_file):
+    """
+    Load a patch bundle and return a dict from plain type to CompiledDiff.
+    The magic and the version are checked before anything is unpickled.
+    Bundles should still only be loaded from trusted sources.
+    """
+    with open(bundle_file, "rb") as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError(f"{bundle_file} is not a patch bundle")
+        header = f.read(BUNDLE_HEADER.size)
+        if len(header) != BUNDLE_HEADER.size:
+            raise ValueError(f"{bundle_file} is truncated")
+        version, = BUNDLE_HEADER.unpack(header)
+        if version != BUNDLE_VERSION:
+            raise ValueError(f"{bundle_file} has bundle version {version}, "
+                             f"expected {BUNDLE_VERSION}; recompile it with compile_patch.py")
+        try:
+            diffs = BundleUnpickler(f).load()
+        except (pickle.UnpicklingError, EOFError) as e:
+            raise ValueError(f"{bundle_file} is not a valid patch bundle: {e}")
+    if not isinstance(diffs, dict):
+        raise ValueError(f"{bundle_file} is not a valid patch bundle")
+    return {plain_type: CompiledDiff(*diff) for plain_type, diff in diffs.items()}
+
+
+def modified_path(source_file, element_type, temp_folder: Path):
+    """
+    Return the path of the patched copy of source_file inside temp_folder.
+    """
     if element_type == "node":
         suffix = ".nod.xml"
     elif element_type == "edge":
         suffix = ".edg.xml"
     elif element_type == "connection":
         suffix = ".con.xml"
+    elif element_type == "tll":
+        suffix = ".tll.xml"
     else:
         suffix = source_file.suffix
+    return temp_folder / (source_file.stem + "_modified" + suffix)
+
+
+def apply_diff(source_file, diff_file, element_type, temp_folder: Path):
+    """
+    Apply an XML diff (add / update / delete) to a SUMO file
+    and return the path of the modified file (inside temp_folder).
+    """
+    source_tree = ET.parse(source_file)
+    source_root = source_tree.getroot()
+    deleted, changed = read_diff(diff_file, element_type)
+
+    source_index = {element_key(elem, element_type): elem for elem in source_root.findall("./*")}
+
+    # Deletions
+    for key in deleted:
+        if key in source_index:
+            source_root.remove(source_index[key])
+            source_index.pop(key)
 
-    new_name = source_file.stem + "_modified" + suffix
-    output_path = temp_folder / new_name
+    # Add / Update
+    for key, diff_elem in changed:
+        if key in source_index:
+            merge_element(source_index[key], diff_elem, element_type)
+        else:
+            strip_missing(diff_elem)
+            source_root.append(diff_elem)
+            source_index[key] = diff_elem
+            if element_type == "edge":
+                clean_lanes(diff_elem)
+
+    # Save modified file into temp_folder
+    output_path = modified_path(source_file, element_type, temp_folder)
     source_tree.write(output_path, encoding="utf-8", xml_declaration=True)
 
     print(f"Changes applied: {output_path}")
     return output_path
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Apply SUMO diffs and regenerate network.")
-    parser.add_argument("subnetwork", type=Path, help="Original subnetwork .net.xml file")
-    parser.add_argument("subnetwork_corrected", type=Path, help="Corrected subnetwork .net.xml file")
-    parser.add_argument("input_network", type=Path, help="Input .net.xml network file to patch")
-    parser.add_argument("-o", "--output", type=Path, required=True, help="Final .net.xml output file")
-    parser.add_argument("--clean", action="store_true", help="Remove .temp directory at the end")
-    args = parser.parse_args()
+def iter_top_level(source_file):
+    """
+    Stream the children of the root element of source_file.
 
-    temp_folder = Path(".temp").resolve()
-    temp_folder.mkdir(parents=True, exist_ok=True)
-    print(f"Using temporary folder: {temp_folder}")
+    Yields (root, elem) once the closing tag of each top-level element has been
+    read, and (root, None) when the root element is closed. Elements are
+    detached from the root after the consumer has handled them.
+    """
+    depth = 0
+    root = None
+    pending = None
+    for event, elem in ET.iterparse(source_file, events=("start", "end")):
+        if event == "start":
+            if depth == 0:
+                root = elem
+            elif depth == 1 and pending is not None:
+                # the tail of the previous sibling is complete once the next one starts
+                yield root, pending
+                root.remove(pending)
+                pending = None
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                pending = elem
+            elif depth == 0:
+                if pending is not None:
+                    yield root, pending
+                    root.remove(pending)
+                yield root, None
+
+
+def apply_diff_streaming(source_file, diff_file, element_type, temp_folder: Path):
+    """
+    Apply an XML diff like apply_diff, keeping only the diff in memory.
 
-    def get_plain_prefix(path):
-        if path.name.endswith(".net.xml"):
-            return temp_folder / path.name[:-len(".net.xml")]
+    The source file is read twice: a first pass locates the elements touched by
+    the diff, a second pass writes every element to the output as soon as it has
+    been patched.
+    """
+    deleted, changed = read_diff(diff_file, element_type)
+    wanted = set(deleted)
+    wanted.update(key for key, _ in changed)
+
+    # First pass: the last element with a given key is the one apply_diff indexes
+    located = {}
+    for position, (root, elem) in enumerate(iter_top_level(source_file)):
+        if elem is not None:
+            key = element_key(elem, element_type)
+            if key in wanted:
+                located[key] = position
+            elem.clear()
+
+    removed = set()
+    for key in deleted:
+        if key in located:
+            removed.add(located.pop(key))
+
+    updates = {}
+    appended = []
+    appended_index = {}
+    for key, diff_elem in changed:
+        if key in located:
+            updates.setdefault(located[key], []).append(diff_elem)
+        elif key in appended_index:
+            merge_element(appended_index[key], diff_elem, element_type)
         else:
-            return temp_folder / path.stem
+            strip_missing(diff_elem)
+            appended.append(diff_elem)
+            appended_index[key] = diff_elem
+            if element_type == "edge":
+                clean_lanes(diff_elem)
+
+    # Second pass: patch and write each element as it is read
+    output_path = modified_path(source_file, element_type, temp_folder)
+    marker = "__ROOT_CONTENT__"
+    with open(output_path, "w", encoding="utf-8") as out:
+        out.write("<?xml version='1.0' encoding='utf-8'?>\n")
+        head = None
+        for position, (root, elem) in enumerate(iter_top_level(source_file)):
+            if head is None:
+                shell = ET.Element(root.tag, root.attrib)
+                shell.text = (root.text or "") + marker
+                head, foot = ET.tostring(shell, encoding="unicode").split(marker)
+                if elem is None and not root.text and not appended:
+                    # empty root, written as a self-closing tag
+                    out.write(ET.tostring(ET.Element(root.tag, root.attrib), encoding="unicode"))
+                    break
+                out.write(head)
+            if elem is None:
+                for diff_elem in appended:
+                    out.write(ET.tostring(diff_elem, encoding="unicode"))
+                out.write(foot)
+                break
+            if position not in removed:
+                for diff_elem in updates.get(position, ()):
+                    merge_element(elem, diff_elem, element_type)
+                out.write(ET.tostring(elem, encoding="unicode"))
+            elem.clear()
+
+    print(f"Changes applied: {output_path}")
+    return output_path
+
 
+def run_plain_exports(stages, jobs=1, cache=None):
+    """
+    Split networks into plain files with netconvert, running at most jobs
+    exports at the same time. stages is a list of (label, net_file, prefix).
+    When a PlainCache is given, cached exports are reused and the plain files
+    stay inside the cache instead of prefix.
+    Return a dict from each requested prefix to the prefix holding the plain
+    files, and the (label, reason) of every export that failed.
+    """
+    def export(stage):
+        label, net_file, prefix = stage
+        if cache is not None:
+            print(f"Getting plain for {label} from cache {cache.cache_dir}...")
+            try:
+                return label, prefix, cache.export(net_file), None
+            except (OSError, subprocess.CalledProcessError) as e:
+                return label, prefix, None, str(e)
+
+        print(f"Generating plain for {label} (into .temp)...")
+        try:
+            result = subprocess.run(
+                ["netconvert", "-s", str(net_file), "--plain-output-prefix", str(prefix)]
+            )
+        except OSError as e:
+            return label, prefix, None, str(e)
+        if result.returncode != 0:
+            return label, prefix, None, f"netconvert exited with status {result.returncode}"
+        return label, prefix, prefix, None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = list(pool.map(export, stages))
+    prefixes = {prefix: plain_prefix for _, prefix, plain_prefix, _ in results}
+    failures = [(label, reason) for label, _, _, reason in results if reason is not None]
+    return prefixes, failures
+
+
+def network_ids(net_file):
+    """
+    Stream a .net.xml file and return the ids of its junctions and edges
+    and the (from, fromLane, to, toLane) keys of its connections,
+    leaving out internal elements.
+    """
+    junctions = set()
+    edges = set()
+    connections = set()
+    for _, elem in iter_top_level(net_file):
+        if elem is None:
+            break
+        if elem.tag == "junction":
+            if elem.get("type") != "internal":
+                junctions.add(elem.get("id"))
+        elif elem.tag == "edge":
+            if elem.get("function") != "internal":
+                edges.add(elem.get("id"))
+        elif elem.tag == "connection":
+            if not elem.get("from", "").startswith(":"):
+                connections.add(element_key(elem, "connection"))
+        elem.clear()
+    return junctions, edges, connections
+
+
+def find_fast_path_conflicts(input_network, diff_files):
+    """
+    Return descriptions of the diff entries netconvert cannot apply directly
+    on input_network: deletions of elements it does not contain and partial
+    updates of elements it does not contain.
+    diff_files maps netdiff plain types to diff file paths.
+    """
+    junctions, edges, connections = network_ids(input_network)
+    conflicts = []
+
+    def diff_elements(plain_type):
+        if plain_type not in diff_files:
+            return []
+        return list(ET.parse(diff_files[plain_type]).getroot())
+
+    for elem in diff_elements(netdiff.TYPE_NODES):
+        node_id = elem.get("id")
+        if elem.tag == "delete" and node_id not in junctions:
+            conflicts.append(f"node '{node_id}' to delete is missing")
+        elif elem.tag == "node" and node_id not in junctions:
+            if elem.get("x") is None or elem.get("y") is None:
+                conflicts.append(f"node '{node_id}' to update is missing")
+
+    available_edges = set(edges)
+    for elem in diff_elements(netdiff.TYPE_EDGES):
+        edge_id = elem.get("id")
+        if elem.tag == "delete":
+            if edge_id not in edges:
+                conflicts.append(f"edge '{edge_id}' to delete is missing")
+            available_edges.discard(edge_id)
+        elif elem.tag == "edge" and edge_id not in edges:
+            if elem.get("from") is None or elem.get("to") is None:
+                conflicts.append(f"edge '{edge_id}' to update is missing")
+            available_edges.add(edge_id)
+
+    for elem in diff_elements(netdiff.TYPE_CONNECTIONS) + diff_elements(netdiff.TYPE_TLLOGICS):
+        key = element_key(elem, "connection")
+        if elem.tag == "delete" and elem.get("from") is not None:
+            # a delete without 'to' stands for an edge without connections
+            if elem.get("to") is not None and key not in connections:
+                conflicts.append(f"connection {key} to delete is missing")
+        elif elem.tag == "connection":
+            for edge_id in (elem.get("from"), elem.get("to")):
+                if edge_id is not None and edge_id not in available_edges:
+                    conflicts.append(f"connection {key} uses missing edge '{edge_id}'")
+    return conflicts
+
+
+def fast_patch(input_network, diff_files, output):
+    """
+    Load input_network and the diff files in a single netconvert run.
+    Return False if the diff cannot be applied that way.
+    """
+    conflicts = find_fast_path_conflicts(input_network, diff_files)
+    if conflicts:
+        for conflict in conflicts:
+            print(f"Fast path conflict: {conflict}")
+        return False
+
+    print("Running netconvert on the input network and the diff (fast path)...")
+    command = ["netconvert", "-s", str(input_network)]
+    for plain_type, option in ((netdiff.TYPE_NODES, "--node-files"),
+                               (netdiff.TYPE_EDGES, "--edge-files"),
+                               (netdiff.TYPE_CONNECTIONS, "--connection-files"),
+                               (netdiff.TYPE_TLLOGICS, "--tllogic-files")):
+        if plain_type in diff_files:
+            command += [option, str(diff_files[plain_type])]
+    command += ["-o", str(output)]
+    result = subprocess.run(command)
+    if result.returncode != 0:
+        print(f"netconvert exited with status {result.returncode} on the fast path")
+        return False
+    return True
+
+
+def get_plain_prefix(path, temp_folder: Path):
+    """
+    Return the prefix for the plain files of the network path inside temp_folder.
+    """
+    if path.name.endswith(".net.xml"):
+        return temp_folder / path.name[:-len(".net.xml")]
+    else:
+        return temp_folder / path.stem
+
+
+def plain_subnetwork_prefixes(subnetwork: Path, subnetwork_corrected: Path, temp_folder: Path):
+    """
+    Return the prefixes of the plain files of the original subnetwork, written
+    next to it by taz_to_net.py --plain, and of the corrected subnetwork,
+    converted into temp_folder with net2plain.py as well. net2plain.py writes
+    the node types netconvert computes (e.g. dead ends at the border of the
+    subnetwork), so the diff is the one of the netconvert exports.
+    Exit if the plain files of the original subnetwork are missing or older
+    than the subnetwork.
+    """
+    # net2plain.py lives in additionals, added to sys.path above
+    from net2plain import convert
+
+    sub_prefix = get_plain_prefix(subnetwork, subnetwork.parent)
+    plain_files = [Path(str(sub_prefix) + plain_type) for plain_type in (".nod.xml", ".edg.xml", ".con.xml")]
+    missing = [str(path) for path in plain_files if not path.exists()]
+    if missing:
+        print(f"Missing plain files of the original subnetwork: {', '.join(missing)}")
+        sys.exit(1)
+    modified = subnetwork.stat().st_mtime
+    stale = [str(path) for path in plain_files if path.stat().st_mtime < modified]
+    if stale:
+        print(f"Plain files older than the original subnetwork {subnetwork}: {', '.join(stale)}")
+        print("Write them again with taz_to_net.py --plain")
+        sys.exit(1)
+
+    # kept apart from the netconvert exports of the other networks in temp_folder
+    sub_corr_prefix = get_plain_prefix(subnetwork_corrected, temp_folder / "plain")
+    sub_corr_prefix.parent.mkdir(exist_ok=True)
+    print("Generating plain for corrected subnetwork with net2plain (into .temp)...")
     try:
+        convert(str(subnetwork_corrected), str(sub_corr_prefix))
+    except (OSError, SyntaxError) as e:
+        print(f"Plain conversion failed for corrected subnetwork: {e}")
+        sys.exit(1)
+    return sub_prefix, sub_corr_prefix
 
-        sub_prefix = get_plain_prefix(args.subnetwork)
-        sub_corr_prefix = get_plain_prefix(args.subnetwork_corrected)
 
-        print("Generating plain for original subnetwork (into .temp)...")
-        subprocess.run(
-            ["netconvert", "-s", str(args.subnetwork), "--plain-output-prefix", str(sub_prefix)],
-            check=True
-        )
+def diff_subnetworks(sub_prefix, sub_corr_prefix, temp_folder: Path, jobs=1, with_text=False,
+                     patch_on_import=False):
+    """
+    Run netdiff in-process on the plain files of the original and the corrected
+    subnetwork and return a dict from plain type to CompiledDiff, built from
+    the records of the netdiff comparison without writing and parsing xml.
+    The diff text is only written with with_text (for --write-diff and --fast).
+    With patch_on_import the diff can be loaded by netconvert together with
+    the input network (netdiff --patch-on-import), as the fast path does.
+    With jobs > 1 the plain types are compared in parallel worker processes.
+    """
+    print("Running netdiff in-process (diffs kept in memory)...")
+    diff_options = netdiff.make_options(
+        str(sub_prefix), str(sub_corr_prefix), str(temp_folder / "diff"), use_prefix=True, jobs=jobs,
+        patch_on_import=patch_on_import
+    )
+    outputs = {plain_type: io.StringIO() if with_text else None for plain_type in netdiff.PLAIN_TYPES}
+    records = {}
+    netdiff.main(diff_options, outputs, records)
+    return {plain_type: compile_records(outputs[plain_type].getvalue() if with_text else "",
+                                        records[plain_type], BUNDLE_TYPES.get(plain_type))
+            for plain_type in netdiff.PLAIN_TYPES}
+
+
+def controlled_programs(node_file):
+    """
+    Return the ids of the traffic lights controlling a node of a plain node file.
+    """
+    programs = set()
+    for _, elem in iter_top_level(node_file):
+        if elem is None:
+            break
+        if elem.tag == "node" and elem.get("type", "").startswith("traffic_light"):
+            programs.add(elem.get("tl", elem.get("id")))
+        elem.clear()
+    return programs
 
-        print("Generating plain for corrected subnetwork (into .temp)...")
-        subprocess.run(
-            ["netconvert", "-s", str(args.subnetwork_corrected), "--plain-output-prefix", str(sub_corr_prefix)],
-            check=True
-        )
 
+def without_unused_programs(tll_file, diff_file, programs):
+    """
+    Return the traffic light diff extended with the deletion of the programs of
+    tll_file that no longer control a node, and of the connections they control.
+    netdiff leaves these deletions implicit in the changed node types, which
+    netconvert only applies when loading the diff with the network.
+    """
+    def program(elem):
+        return elem.get("tl") if elem.get("from") is not None else elem.get("id")
 
-        print("Running netdiff.py with --use-prefix (outputs into .temp/diff.*)...")
-        subprocess.run(
-            [sys.executable, "netdiff.py", "--use-prefix", str(sub_prefix), str(sub_corr_prefix), str(temp_folder / "diff")],
-            check=True
-        )
+    deleted, changed = read_diff(diff_file, "tll")
+    for _, elem in iter_top_level(tll_file):
+        if elem is None:
+            break
+        if elem.tag in ("tlLogic", "connection") and program(elem) not in programs:
+            deleted.append(element_key(elem, "tll"))
+        elem.clear()
+    changed = [(key, element_record(elem)) for key, elem in changed if program(elem) in programs]
+    return CompiledDiff("", tuple(deleted), tuple(changed))
+
+
+def write_diff_files(diffs, temp_folder: Path):
+    """
+    Write the non-empty diffs (texts or CompiledDiff) to temp_folder/diff.*
+    and return a dict from plain type to file path.
+    """
+    diff_files = {}
+    for plain_type, diff in diffs.items():
+        text = diff.text if isinstance(diff, CompiledDiff) else diff
+        if text:
+            diff_files[plain_type] = temp_folder / ("diff" + plain_type)
+            with open(diff_files[plain_type], "w", encoding="utf-8") as f:
+                f.write(text)
+    return diff_files
 
-        diff_node = temp_folder / "diff.nod.xml"
-        diff_edge = temp_folder / "diff.edg.xml"
-        diff_con  = temp_folder / "diff.con.xml"
 
+def patch_plain_files(input_prefix, diffs, output, temp_folder: Path, streaming=False):
+    """
+    Apply the node, edge, connection and traffic light diffs (texts or
+    CompiledDiff) to the plain files of the input network, the same diff types
+    the fast path loads, and rebuild the patched network with netconvert.
+    The configuration netconvert writes with the plain files keeps the
+    processing options of the input network (internal links, offsets, ...),
+    all input files are given explicitly.
+    """
+    def diff_source(plain_type):
+        diff = diffs[plain_type]
+        return diff if isinstance(diff, CompiledDiff) else io.StringIO(diff)
+
+    node_file = input_prefix.with_suffix(".nod.xml")
+    edge_file = input_prefix.with_suffix(".edg.xml")
+    con_file  = input_prefix.with_suffix(".con.xml")
+    tll_file  = input_prefix.with_suffix(".tll.xml")
+    type_file = input_prefix.with_suffix(".typ.xml")
+    config_file = input_prefix.with_suffix(".netccfg")
+
+    patch = apply_diff_streaming if streaming else apply_diff
+    modified_node = patch(node_file, diff_source(netdiff.TYPE_NODES), "node", temp_folder)
+    modified_edge = patch(edge_file, diff_source(netdiff.TYPE_EDGES), "edge", temp_folder)
+    modified_con  = patch(con_file, diff_source(netdiff.TYPE_CONNECTIONS), "connection", temp_folder)
+    command = ["netconvert"]
+    if config_file.exists():
+        # the files given below replace those of the configuration
+        command += ["-c", str(config_file)]
+    command += [
+        "--node-files", str(modified_node),
+        "--edge-files", str(modified_edge),
+        "--connection-files", str(modified_con),
+    ]
+    if type_file.exists():
+        command += ["--type-files", str(type_file)]
+    if tll_file.exists():
+        tll_diff = without_unused_programs(tll_file, diff_source(netdiff.TYPE_TLLOGICS),
+                                           controlled_programs(modified_node))
+        modified_tll = patch(tll_file, tll_diff, "tll", temp_folder)
+        command += ["--tllogic-files", str(modified_tll)]
+
+    print("Running netconvert to generate final network (output outside .temp)...")
+    subprocess.run(command + ["-o", str(output)], check=True)
 
-        input_prefix = get_plain_prefix(args.input_network)
-        print("Splitting input_network into plain files (into .temp)...")
-        subprocess.run(
-            ["netconvert", "-s", str(args.input_network), "--plain-output-prefix", str(input_prefix)],
-            check=True
-        )
 
-        node_file = input_prefix.with_suffix(".nod.xml")
-        edge_file = input_prefix.with_suffix(".edg.xml")
-        con_file  = input_prefix.with_suffix(".con.xml")
+def main():
+    parser = argparse.ArgumentParser(description="Apply SUMO diffs and regenerate network.")
+    parser.add_argument("networks", type=Path, nargs="+", metavar="network",
+                        help="Original subnetwork, corrected subnetwork and input .net.xml network to patch "
+                             "(only the input network when --bundle is given)")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="Final .net.xml output file")
+    parser.add_argument("--clean", action="store_true", help="Remove .temp directory at the end")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Apply diffs with constant memory instead of loading whole plain files")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of netconvert plain exports and netdiff file types to process in parallel")
+    parser.add_argument("--cache-dir", type=Path,
+                        help="Reuse plain exports of unchanged networks stored in this directory")
+    parser.add_argument("--cache-size", type=int, default=10240,
+                        help="Maximum size of the plain export cache in MB (default: 10240)")
+    parser.add_argument("--write-diff", action="store_true",
+                        help="Also write the netdiff output to .temp/diff.* (diffs are otherwise kept in memory)")
+    parser.add_argument("--fast", action="store_true",
+                        help="Load the input network and the diff in a single netconvert run, "
+                             "falling back to patching plain files on conflicts")
+    parser.add_argument("--bundle", type=Path,
+                        help="Apply a patch bundle written by compile_patch.py instead of diffing subnetworks "
+                             "(only load bundles from trusted sources)")
+    parser.add_argument("--plain-subnetwork", action="store_true",
+                        help="Use the plain files written next to the original subnetwork "
+                             "(taz_to_net.py --plain) and convert the corrected subnetwork with net2plain.py "
+                             "instead of exporting both with netconvert")
+    args = parser.parse_args()
+    if args.bundle is not None:
+        if len(args.networks) != 1:
+            parser.error("with --bundle only the input network is given")
+        if args.plain_subnetwork:
+            parser.error("--plain-subnetwork cannot be used with --bundle")
+        args.input_network, = args.networks
+    else:
+        if len(args.networks) != 3:
+            parser.error("expected the subnetwork, the corrected subnetwork and the input network")
+        args.subnetwork, args.subnetwork_corrected, args.input_network = args.networks
 
+    temp_folder = Path(".temp").resolve()
+    temp_folder.mkdir(parents=True, exist_ok=True)
+    print(f"Using temporary folder: {temp_folder}")
 
-        modified_node = apply_diff(node_file, diff_node, "node", temp_folder)
-        modified_edge = apply_diff(edge_file, diff_edge, "edge", temp_folder)
-        modified_con  = apply_diff(con_file, diff_con, "connection", temp_folder)
+    cache = None
+    try:
 
+        stages = {}
+        if args.bundle is None:
+            sub_prefix = get_plain_prefix(args.subnetwork, temp_folder)
+            sub_corr_prefix = get_plain_prefix(args.subnetwork_corrected, temp_folder)
+            subnetworks = (args.subnetwork.resolve(), args.subnetwork_corrected.resolve())
+            if args.plain_subnetwork:
+                sub_prefix, sub_corr_prefix = plain_subnetwork_prefixes(
+                    args.subnetwork, args.subnetwork_corrected, temp_folder
+                )
+            else:
+                stages[sub_prefix] = ("original subnetwork", args.subnetwork, sub_prefix)
+                stages.setdefault(sub_corr_prefix,
+                                  ("corrected subnetwork", args.subnetwork_corrected, sub_corr_prefix))
+        else:
+            sub_prefix = sub_corr_prefix = None
+            subnetworks = ()
+
+        input_prefix = get_plain_prefix(args.input_network, temp_folder)
+        if (input_prefix in (sub_prefix, sub_corr_prefix)
+                and args.input_network.resolve() not in subnetworks):
+            # keep the input plain files apart from the subnetwork ones exported at the same time
+            input_prefix = temp_folder / "input" / input_prefix.name
+            input_prefix.parent.mkdir(exist_ok=True)
+        if not args.fast:
+            # identical networks are only exported once, the fast path only needs it on fallback
+            stages.setdefault(input_prefix, ("input network", args.input_network, input_prefix))
+
+        if args.cache_dir is not None:
+            cache = PlainCache(args.cache_dir, args.cache_size * 1024 * 1024)
+        prefixes, failures = run_plain_exports(list(stages.values()), args.jobs, cache)
+        if failures:
+            for label, reason in failures:
+                print(f"Plain export failed for {label}: {reason}")
+            sys.exit(1)
+        if args.plain_subnetwork:
+            prefixes[sub_prefix] = sub_prefix
+            prefixes[sub_corr_prefix] = sub_corr_prefix
+
+        if args.bundle is None:
+            diffs = diff_subnetworks(prefixes[sub_prefix], prefixes[sub_corr_prefix], temp_folder, args.jobs,
+                                     args.write_diff or args.fast)
+        else:
+            print(f"Loading patch bundle {args.bundle}...")
+            try:
+                diffs = load_bundle(args.bundle)
+            except (OSError, ValueError) as e:
+                print(f"Cannot load patch bundle: {e}")
+                sys.exit(1)
+        diff_files = {}
+        if args.write_diff or args.fast:
+            # netconvert reads the diff from disk on the fast path
+            diff_files = write_diff_files(diffs, temp_folder)
+
+        if args.fast:
+            if fast_patch(args.input_network, diff_files, args.output):
+                print(f"Network generated: {args.output}")
+                return
+            print("Falling back to patching plain files...")
+            if input_prefix not in prefixes:
+                prefixes, failures = run_plain_exports(
+                    [("input network", args.input_network, input_prefix)], 1, cache
+                )
+                if failures:
+                    for label, reason in failures:
+                        print(f"Plain export failed for {label}: {reason}")
+                    sys.exit(1)
+        input_prefix = prefixes[input_prefix]
 
-        print("Running netconvert to generate final network (output outside .temp)...")
-        subprocess.run([
-            "netconvert",
-            "--node-files", str(modified_node),
-            "--edge-files", str(modified_edge),
-            "--connection-files", str(modified_con),
-            "-o", str(args.output)
-        ], check=True)
+        patch_plain_files(input_prefix, diffs, args.output, temp_folder, args.streaming)
 
         print(f"Network generated: {args.output}")
 
@@ -203,6 +892,8 @@ def main():
         print("A subprocess failed:", e)
         sys.exit(1)
     finally:
+        if cache is not None:
+            cache.close()
         if args.clean:
             if temp_folder.exists():
                 print(f"Removing temporary folder {temp_folder}...")
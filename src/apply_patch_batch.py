@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Apply the correction of one subnetwork to many input networks.
+
+The diff between the original and the corrected subnetwork is computed once,
+then every input network is patched in its own process.
+
+Usage:
+    python apply_patch_batch.py <subnetwork> <subnetwork_corrected> <input_network>... -O <output_dir>
+    python apply_patch_batch.py --bundle <bundle_file> <input_network>... -O <output_dir>
+"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import shutil
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from apply_patch import (diff_subnetworks, fast_patch, get_plain_prefix, load_bundle, patch_plain_files,
+                         plain_subnetwork_prefixes, run_plain_exports, write_diff_files)
+from plain_cache import PlainCache
+
+
+def patch_target(input_network, diffs, output, temp_folder: Path,
+                 streaming=False, fast=False, cache_dir=None, cache_size=10240):
+    """
+    Patch one input network with the given diffs (texts or CompiledDiff).
+    Return (input_network, output, elapsed seconds, error or None), errors of
+    netconvert and of malformed files are returned instead of raised.
+    """
+    start = time.perf_counter()
+    temp_folder.mkdir(parents=True, exist_ok=True)
+    error = None
+    cache = None
+    try:
+        if fast and fast_patch(input_network, write_diff_files(diffs, temp_folder), output):
+            return input_network, output, time.perf_counter() - start, None
+
+        if cache_dir is not None:
+            cache = PlainCache(cache_dir, cache_size * 1024 * 1024)
+        input_prefix = get_plain_prefix(input_network, temp_folder)
+        prefixes, failures = run_plain_exports([("input network", input_network, input_prefix)], 1, cache)
+        if failures:
+            error = "; ".join(reason for _, reason in failures)
+        else:
+            patch_plain_files(prefixes[input_prefix], diffs, output, temp_folder, streaming)
+    except (OSError, subprocess.CalledProcessError) as e:
+        error = str(e)
+    except (ET.ParseError, ValueError, KeyError) as e:
+        # malformed input network or diff, reported with the other targets
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        if cache is not None:
+            cache.close()
+    return input_network, output, time.perf_counter() - start, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply one subnetwork correction to several networks.")
+    parser.add_argument("networks", type=Path, nargs="+", metavar="network",
+                        help="Original subnetwork, corrected subnetwork and the input .net.xml networks to patch "
+                             "(only the input networks when --bundle is given)")
+    parser.add_argument("-O", "--output-dir", type=Path, required=True,
+                        help="Directory receiving one patched .net.xml per input network")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of input networks to patch (and netdiff file types to compare) in parallel")
+    parser.add_argument("--clean", action="store_true", help="Remove .temp directory at the end")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Apply diffs with constant memory instead of loading whole plain files")
+    parser.add_argument("--fast", action="store_true",
+                        help="Load each input network and the diff in a single netconvert run, "
+                             "falling back to patching plain files on conflicts")
+    parser.add_argument("--cache-dir", type=Path,
+                        help="Reuse plain exports of unchanged networks stored in this directory")
+    parser.add_argument("--cache-size", type=int, default=10240,
+                        help="Maximum size of the plain export cache in MB (default: 10240)")
+    parser.add_argument("--bundle", type=Path,
+                        help="Apply a patch bundle written by compile_patch.py instead of diffing subnetworks "
+                             "(only load bundles from trusted sources)")
+    parser.add_argument("--plain-subnetwork", action="store_true",
+                        help="Use the plain files written next to the original subnetwork "
+                             "(taz_to_net.py --plain) and convert the corrected subnetwork with net2plain.py "
+                             "instead of exporting both with netconvert")
+    args = parser.parse_args()
+    if args.bundle is not None:
+        if args.plain_subnetwork:
+            parser.error("--plain-subnetwork cannot be used with --bundle")
+        args.input_networks = args.networks
+    else:
+        if len(args.networks) < 3:
+            parser.error("expected the subnetwork, the corrected subnetwork and at least one input network")
+        args.subnetwork, args.subnetwork_corrected = args.networks[:2]
+        args.input_networks = args.networks[2:]
+
+    names = [path.name for path in args.input_networks]
+    if len(set(names)) != len(names):
+        parser.error("input networks must have distinct file names")
+
+    temp_folder = Path(".temp").resolve()
+    temp_folder.mkdir(parents=True, exist_ok=True)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Using temporary folder: {temp_folder}")
+
+    try:
+        if args.bundle is not None:
+            print(f"Loading patch bundle {args.bundle}...")
+            try:
+                diffs = load_bundle(args.bundle)
+            except (OSError, ValueError) as e:
+                print(f"Cannot load patch bundle: {e}")
+                sys.exit(1)
+        else:
+            sub_prefix = get_plain_prefix(args.subnetwork, temp_folder)
+            sub_corr_prefix = get_plain_prefix(args.subnetwork_corrected, temp_folder)
+            if args.plain_subnetwork:
+                sub_prefix, sub_corr_prefix = plain_subnetwork_prefixes(
+                    args.subnetwork, args.subnetwork_corrected, temp_folder
+                )
+                stages = []
+            else:
+                stages = [("original subnetwork", args.subnetwork, sub_prefix),
+                          ("corrected subnetwork", args.subnetwork_corrected, sub_corr_prefix)]
+            cache = None
+            if args.cache_dir is not None:
+                cache = PlainCache(args.cache_dir, args.cache_size * 1024 * 1024)
+            try:
+                prefixes, failures = run_plain_exports(stages, min(args.jobs, 2), cache)
+                if failures:
+                    for label, reason in failures:
+                        print(f"Plain export failed for {label}: {reason}")
+                    sys.exit(1)
+                if args.plain_subnetwork:
+                    prefixes[sub_prefix] = sub_prefix
+                    prefixes[sub_corr_prefix] = sub_corr_prefix
+                diffs = diff_subnetworks(prefixes[sub_prefix], prefixes[sub_corr_prefix], temp_folder, args.jobs,
+                                         args.fast)
+            finally:
+                if cache is not None:
+                    cache.close()
+
+        with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            futures = [
+                pool.submit(patch_target, input_network, diffs,
+                            args.output_dir / input_network.name,
+                            temp_folder / f"target{index}",
+                            args.streaming, args.fast, args.cache_dir, args.cache_size)
+                for index, input_network in enumerate(args.input_networks)
+            ]
+            results = [future.result() for future in futures]
+
+        print("Patched networks:")
+        failed = False
+        for input_network, output, elapsed, error in results:
+            if error is None:
+                print(f"  {input_network} -> {output} ({elapsed:.1f} s)")
+            else:
+                failed = True
+                print(f"  {input_network} FAILED after {elapsed:.1f} s: {error}")
+        if failed:
+            sys.exit(1)
+
+    except subprocess.CalledProcessError as e:
+        print("A subprocess failed:", e)
+        sys.exit(1)
+    finally:
+        if args.clean:
+            if temp_folder.exists():
+                print(f"Removing temporary folder {temp_folder}...")
+                shutil.rmtree(temp_folder)
+
+
+if __name__ == "__main__":
+    main()
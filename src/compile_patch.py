@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Compile the diff files written by netdiff into a binary patch bundle.
+
+The bundle stores the diffs with their element keys already computed, so that
+apply_patch.py --bundle can apply them without parsing XML again. It starts
+with a magic and a format version checked before the diffs are unpickled, and
+the diffs only consist of builtin containers and strings. Bundles should still
+only be exchanged between trusted parties.
+
+Usage:
+    python compile_patch.py <diff_prefix> -o <bundle_file>
+
+Example:
+    python compile_patch.py .temp/diff -o correction.patch.bin
+"""
+from pathlib import Path
+import argparse
+import sys
+
+from apply_patch import BUNDLE_TYPES, compile_bundle, load_bundle
+import netdiff  # found through the sys.path entry added by apply_patch
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile netdiff output into a patch bundle.")
+    parser.add_argument("diff_prefix", help="Prefix of the diff files (<prefix>.nod.xml, <prefix>.edg.xml, ...)")
+    parser.add_argument("-o", "--output", type=Path, required=True, help="Patch bundle output file")
+    args = parser.parse_args()
+
+    diff_texts = {}
+    for plain_type in netdiff.PLAIN_TYPES:
+        diff_file = Path(args.diff_prefix + plain_type)
+        if diff_file.is_file():
+            diff_texts[plain_type] = diff_file.read_text(encoding="utf-8")
+    if not diff_texts:
+        sys.exit(f"No diff files found for prefix {args.diff_prefix}")
+
+    compile_bundle(diff_texts, args.output)
+    diffs = load_bundle(args.output)
+    for plain_type, diff in diffs.items():
+        if diff.text and plain_type in BUNDLE_TYPES:
+            print(f"{plain_type}: {len(diff.deleted)} deletions, {len(diff.changed)} additions/updates")
+        elif diff.text:
+            print(f"{plain_type}: stored for the fast path only")
+    print(f"Patch bundle written: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
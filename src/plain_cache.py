@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Persistent cache for the plain xml files netconvert exports from a .net.xml network.
+
+Entries are keyed by a hash of the network content, the netconvert version and
+the export options. Once the cache grows beyond its size limit the least
+recently used entries are removed.
+
+The netconvert configuration written with the export refers to the plain files
+relative to the entry, so the entry can be used as a plain prefix after it was
+moved into place.
+
+Every process pins the entries it hands out with a file in the .pins directory
+of the cache until it is closed, so that no process evicts an entry another
+one is still reading. Pins left behind by crashed processes expire after a day.
+"""
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+# part of every key, increased when the layout of the entries changes
+CACHE_VERSION = 2
+PLAIN_NAME = "plain"
+CONFIG_SUFFIX = ".netccfg"
+DIGESTS_FILE = "digests.json"
+TEMP_PREFIX = ".tmp-"
+PINS_DIR = ".pins"
+# age in seconds after which the pin of a process is considered stale
+PIN_MAX_AGE = 24 * 60 * 60
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """
+    Return the sha256 hex digest of the content of path.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_size(entry):
+    """
+    Return the total size in bytes of the files of a cache entry.
+    """
+    return sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+
+
+def relocate_config(config_file):
+    """
+    Rewrite the input files of a netconvert configuration that lie next to it
+    relative to it, netconvert resolves them against the configuration.
+    """
+    directory = Path(config_file).resolve().parent
+    tree = ET.parse(config_file)
+    for option in tree.getroot().iterfind("input/*"):
+        paths = option.get("value", "").split(",")
+        option.set("value", ",".join(Path(path).name if Path(path).parent == directory else path
+                                     for path in paths))
+    tree.write(config_file, encoding="UTF-8", xml_declaration=True)
+
+
+class PlainCache:
+    """
+    Content-addressed store of netconvert plain exports.
+    """
+
+    def __init__(self, cache_dir, max_size, netconvert="netconvert"):
+        self.cache_dir = Path(cache_dir).resolve()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # size limit in bytes
+        self.max_size = max_size
+        self.netconvert = netconvert
+        self._version = None
+        self._lock = threading.Lock()
+        # pin file of every key handed out by this instance, removed by close()
+        self._pins = {}
+        (self.cache_dir / PINS_DIR).mkdir(exist_ok=True)
+
+    def netconvert_version(self):
+        """
+        Return the first line of `netconvert --version`, which identifies the build.
+        """
+        if self._version is None:
+            output = subprocess.run([self.netconvert, "--version"], check=True,
+                                    stdout=subprocess.PIPE, universal_newlines=True).stdout
+            self._version = output.strip().splitlines()[0] if output.strip() else ""
+        return self._version
+
+    def network_digest(self, net_file):
+        """
+        Return the content hash of net_file, reusing the stored hash while
+        the size and modification time of the file are unchanged.
+        """
+        net_file = Path(net_file).resolve()
+        stat = net_file.stat()
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        digests_path = self.cache_dir / DIGESTS_FILE
+        with self._lock:
+            try:
+                with open(digests_path) as f:
+                    digests = json.load(f)
+            except (OSError, ValueError):
+                digests = {}
+            known = digests.get(str(net_file))
+            if known is not None and known[:2] == stamp:
+                return known[2]
+        digest = file_digest(net_file)
+        with self._lock:
+            try:
+                with open(digests_path) as f:
+                    digests = json.load(f)
+            except (OSError, ValueError):
+                digests = {}
+            digests[str(net_file)] = stamp + [digest]
+            fd, tmp = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self.cache_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump(digests, f)
+            os.replace(tmp, digests_path)
+        return digest
+
+    def key(self, net_file, options=()):
+        """
+        Return the cache key of the plain export of net_file with the given options.
+        """
+        key = hashlib.sha256()
+        key.update(str(CACHE_VERSION).encode())
+        key.update(b"\0" + self.network_digest(net_file).encode())
+        key.update(b"\0" + self.netconvert_version().encode())
+        for option in options:
+            key.update(b"\0" + str(option).encode())
+        return key.hexdigest()
+
+    def export(self, net_file, options=()):
+        """
+        Return the prefix of the plain files of net_file, running netconvert
+        only if they are not cached yet.
+        """
+        key = self.key(net_file, options)
+        self.pin(key)
+        entry = self.cache_dir / key
+        if entry.is_dir():
+            try:
+                # mark as recently used
+                os.utime(entry)
+                return entry / PLAIN_NAME
+            except OSError:
+                # evicted by another process before the pin was taken
+                pass
+
+        build_dir = Path(tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=self.cache_dir))
+        try:
+            subprocess.run([self.netconvert, "-s", str(net_file),
+                            "--plain-output-prefix", str(build_dir / PLAIN_NAME)] + list(options),
+                           check=True)
+            config_file = build_dir / (PLAIN_NAME + CONFIG_SUFFIX)
+            if config_file.exists():
+                # the build directory is renamed to the entry below
+                relocate_config(config_file)
+            try:
+                os.rename(build_dir, entry)
+            except OSError:
+                # another process stored the same export in the meantime
+                if not entry.is_dir():
+                    raise
+        finally:
+            if build_dir.exists():
+                shutil.rmtree(build_dir)
+        self.evict()
+        return entry / PLAIN_NAME
+
+    def pin(self, key):
+        """
+        Protect the entry key from eviction by any process until close() is called.
+        """
+        with self._lock:
+            if key not in self._pins:
+                fd, pin = tempfile.mkstemp(prefix=key + ".", dir=self.cache_dir / PINS_DIR)
+                os.close(fd)
+                self._pins[key] = pin
+
+    def is_pinned(self, key):
+        """
+        Return whether a process holds a pin on the entry key, removing stale pins.
+        """
+        pinned = False
+        for pin in (self.cache_dir / PINS_DIR).glob(key + ".*"):
+            try:
+                if time.time() - pin.stat().st_mtime > PIN_MAX_AGE:
+                    pin.unlink()
+                else:
+                    pinned = True
+            except OSError:
+                pass
+        return pinned
+
+    def close(self):
+        """
+        Release the pins of the entries handed out by this instance.
+        """
+        with self._lock:
+            for pin in self._pins.values():
+                try:
+                    os.remove(pin)
+                except OSError:
+                    pass
+            self._pins.clear()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its size limit.
+        Entries pinned by any process are kept.
+        """
+        entries = [e for e in self.cache_dir.iterdir()
+                   if e.is_dir() and not e.name.startswith((TEMP_PREFIX, PINS_DIR))]
+        sizes = {e: entry_size(e) for e in entries}
+        total = sum(sizes.values())
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total <= self.max_size:
+                break
+            if self.is_pinned(entry.name):
+                continue
+            # move the entry away before checking the pins again, a process
+            # pinning it in the meantime finds it missing and exports it again
+            doomed = Path(tempfile.mkdtemp(prefix=TEMP_PREFIX, dir=self.cache_dir)) / entry.name
+            try:
+                os.rename(entry, doomed)
+            except OSError:
+                shutil.rmtree(doomed.parent, ignore_errors=True)
+                continue
+            if self.is_pinned(entry.name):
+                try:
+                    os.rename(doomed, entry)
+                except OSError:
+                    # the pinning process stored a new export already
+                    pass
+                else:
+                    shutil.rmtree(doomed.parent, ignore_errors=True)
+                    continue
+            shutil.rmtree(doomed.parent, ignore_errors=True)
+            total -= sizes[entry]
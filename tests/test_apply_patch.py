@@ -0,0 +1,102 @@
+"""
+The fast path and the plain file path of apply_patch.py give the same network.
+
+Requires netconvert and sumolib, the test is skipped without netconvert.
+"""
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+ROOT = Path(__file__).resolve().parent.parent
+APPLY_PATCH = ROOT / "src" / "apply_patch.py"
+APPLY_PATCH_BATCH = ROOT / "src" / "apply_patch_batch.py"
+NET2PLAIN = ROOT / "src" / "additionals" / "net2plain.py"
+DEMO = ROOT / "demo"
+
+
+def network_body(net_file):
+    """
+    Return the network without the header comment naming the input files.
+    """
+    text = Path(net_file).read_text(encoding="utf-8")
+    return text[text.index("-->") + len("-->"):]
+
+
+def diff_elements(temp_folder):
+    """
+    Return the sorted canonical elements of the diff files written to temp_folder.
+    """
+    return sorted(ET.canonicalize(ET.tostring(child, encoding="unicode"), strip_text=True)
+                  for diff_file in sorted(temp_folder.glob("diff.*.xml"))
+                  for child in ET.parse(diff_file).getroot())
+
+
+@unittest.skipIf(shutil.which("netconvert") is None, "netconvert is not installed")
+class FastPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        for name in ("subnetwork.net.xml", "subnetwork_corrected.net.xml"):
+            shutil.copy(DEMO / name, self.work_dir / name)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def patch(self, output, *options):
+        subprocess.run([sys.executable, str(APPLY_PATCH), *options, "--clean", "-o", output,
+                        "subnetwork.net.xml", "subnetwork_corrected.net.xml", "subnetwork.net.xml"],
+                       cwd=self.work_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return self.work_dir / output
+
+    def written_diff(self, *options):
+        subprocess.run([sys.executable, str(APPLY_PATCH), *options, "--write-diff", "-o", "diff.net.xml",
+                        "subnetwork.net.xml", "subnetwork_corrected.net.xml", "subnetwork.net.xml"],
+                       cwd=self.work_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elements = diff_elements(self.work_dir / ".temp")
+        shutil.rmtree(self.work_dir / ".temp")
+        return elements
+
+    def patch_batch(self, output_dir, *options):
+        subprocess.run([sys.executable, str(APPLY_PATCH_BATCH), *options, "-O", output_dir,
+                        "subnetwork.net.xml", "subnetwork_corrected.net.xml", "subnetwork.net.xml"],
+                       cwd=self.work_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return self.work_dir / output_dir / "subnetwork.net.xml"
+
+    def test_fast_path_matches_plain_files(self):
+        plain = self.patch("plain.net.xml")
+        streaming = self.patch("streaming.net.xml", "--streaming")
+        fast = self.patch("fast.net.xml", "--fast")
+        self.assertEqual(network_body(plain), network_body(fast))
+        self.assertEqual(network_body(streaming), network_body(fast))
+
+    def test_cache_dir_matches_plain_files(self):
+        plain = network_body(self.patch("plain.net.xml"))
+        # the second run of each reuses the plain exports stored in the cache
+        for name, options in (("cached", ()), ("cached_jobs", ("-j", "2")), ("cached_streaming", ("--streaming",))):
+            for run in range(2):
+                cached = self.patch(f"{name}{run}.net.xml", "--cache-dir", "cache", *options)
+                self.assertEqual(network_body(cached), plain, name)
+        batch = self.patch_batch("batch", "--cache-dir", "cache")
+        self.assertEqual(network_body(batch), plain)
+
+    def test_plain_subnetwork_matches_plain_files(self):
+        plain = network_body(self.patch("plain.net.xml"))
+        # the plain files taz_to_net.py --plain writes next to the subnetwork
+        subprocess.run([sys.executable, str(NET2PLAIN), "subnetwork.net.xml", "subnetwork"],
+                       cwd=self.work_dir, check=True)
+        # netconvert makes the border nodes of the subnetwork dead ends again, the
+        # diff must not change them in the network it is applied to
+        self.assertEqual(self.written_diff("--plain-subnetwork"), self.written_diff())
+        for options in ((), ("--streaming",), ("--fast",)):
+            patched = self.patch("plain_subnetwork.net.xml", "--plain-subnetwork", *options)
+            self.assertEqual(network_body(patched), plain, options)
+        batch = self.patch_batch("batch", "--plain-subnetwork")
+        self.assertEqual(network_body(batch), plain)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Patch bundles are checked before their diffs are unpickled.
+"""
+from pathlib import Path
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import apply_patch  # noqa: E402
+
+NODE_DIFF = """<?xml version="1.0" encoding="UTF-8"?>
+<nodes>
+    <delete id="a"/>
+    <node id="b" x="1.00" y="2.00"/>
+</nodes>
+"""
+
+
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.bundle_file = self.work_dir / "correction.patch.bin"
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write(self, content):
+        self.bundle_file.write_bytes(content)
+
+    def test_round_trip(self):
+        apply_patch.compile_bundle({".nod.xml": NODE_DIFF}, self.bundle_file)
+        diffs = apply_patch.load_bundle(self.bundle_file)
+        nodes = diffs[".nod.xml"]
+        self.assertEqual(nodes.text, NODE_DIFF)
+        self.assertEqual(nodes.deleted, ("a",))
+        self.assertEqual([key for key, record in nodes.changed], ["b"])
+        self.assertEqual(diffs[".edg.xml"].text, "")
+
+    def test_rejects_other_files(self):
+        self.write(b"<nodes/>")
+        with self.assertRaises(ValueError):
+            apply_patch.load_bundle(self.bundle_file)
+
+    def test_version_checked_before_unpickling(self):
+        # the payload would fail to unpickle, the version must be rejected first
+        self.write(apply_patch.BUNDLE_MAGIC + apply_patch.BUNDLE_HEADER.pack(apply_patch.BUNDLE_VERSION + 1)
+                   + b"garbage")
+        with self.assertRaisesRegex(ValueError, "bundle version"):
+            apply_patch.load_bundle(self.bundle_file)
+
+    def test_rejects_globals(self):
+        self.write(apply_patch.BUNDLE_MAGIC + apply_patch.BUNDLE_HEADER.pack(apply_patch.BUNDLE_VERSION)
+                   + pickle.dumps({".nod.xml": (os.getcwd, (), ())}))
+        with self.assertRaisesRegex(ValueError, "cannot contain"):
+            apply_patch.load_bundle(self.bundle_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
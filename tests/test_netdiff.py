@@ -0,0 +1,184 @@
+"""
+The options of netdiff.py give the same diff as the default comparison.
+
+Requires netconvert and sumolib, the test is skipped without netconvert.
+"""
+from pathlib import Path
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+ROOT = Path(__file__).resolve().parent.parent
+NETDIFF = ROOT / "src" / "additionals" / "netdiff.py"
+DEMO = ROOT / "demo"
+PLAIN_TYPES = (".nod.xml", ".edg.xml", ".con.xml", ".tll.xml", ".typ.xml")
+
+SOURCE_NODES = """<nodes>
+    <node id="a" x="0.00" y="0.00"/>
+    <node id="b" x="100.00" y="0.00" type="priority"/>
+    <node id="c" x="200.00" y="0.00"/>
+    <node id="d" x="300.00" y="0.00"/>
+</nodes>
+"""
+# a and b moved by 0.05, c by 0.2 and d by 0.08 along both axes (0.113 apart)
+DEST_NODES = """<nodes>
+    <node id="a" x="0.03" y="0.04"/>
+    <node id="b" x="100.00" y="0.05" type="traffic_light"/>
+    <node id="c" x="200.00" y="0.20"/>
+    <node id="d" x="300.08" y="0.08"/>
+</nodes>
+"""
+SOURCE_EDGES = """<edges>
+    <edge id="ab" from="a" to="b" shape="0.00,0.00 50.00,10.00 100.00,0.00"/>
+    <edge id="bc" from="b" to="c" shape="100.00,0.00 150.00,10.00 200.00,0.00"/>
+</edges>
+"""
+DEST_EDGES = """<edges>
+    <edge id="ab" from="a" to="b" shape="0.03,0.04 50.00,10.05 100.00,0.05"/>
+    <edge id="bc" from="b" to="c" shape="100.00,0.00 150.00,10.50 200.00,0.20"/>
+</edges>
+"""
+
+
+def diff_body(diff_file):
+    """
+    Return the diff without the header comment naming the options.
+    """
+    text = Path(diff_file).read_text(encoding="utf-8")
+    return text[text.index("-->") + len("-->"):]
+
+
+def diff_elements(diff_file):
+    """
+    Return the sorted canonical elements of a diff file, without its header.
+    """
+    root = ET.parse(diff_file).getroot()
+    return sorted(ET.canonicalize(ET.tostring(child, encoding="unicode"), strip_text=True)
+                  for child in root)
+
+
+@unittest.skipIf(shutil.which("netconvert") is None, "netconvert is not installed")
+class NetdiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        for name in ("subnetwork.net.xml", "subnetwork_corrected.net.xml"):
+            shutil.copy(DEMO / name, self.work_dir / name)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def netdiff(self, outprefix, *args):
+        subprocess.run([sys.executable, str(NETDIFF), *args, outprefix],
+                       cwd=self.work_dir, check=True, stdout=subprocess.DEVNULL)
+
+    def compare(self, outprefix, *options):
+        self.netdiff(outprefix, *options, "subnetwork.net.xml", "subnetwork_corrected.net.xml")
+
+    def plain_files(self):
+        return [name for name in os.listdir(self.work_dir)
+                if name.startswith("subnetwork") and name.endswith(PLAIN_TYPES)]
+
+    def assertSameText(self, outprefix, expected="default"):
+        for plain_type in PLAIN_TYPES:
+            self.assertEqual(diff_body(self.work_dir / (outprefix + plain_type)),
+                             diff_body(self.work_dir / (expected + plain_type)), plain_type)
+
+    def assertSameDiff(self, outprefix, expected="default"):
+        for plain_type in PLAIN_TYPES:
+            self.assertEqual(diff_elements(self.work_dir / (outprefix + plain_type)),
+                             diff_elements(self.work_dir / (expected + plain_type)), plain_type)
+
+    def test_native_matches_netconvert(self):
+        self.compare("default")
+        self.compare("native", "--native", "--remove-plain")
+        self.assertSameDiff("native")
+        # the border nodes of the cut subnetwork are dead ends on both sides
+        nodes = (self.work_dir / "native.nod.xml").read_text(encoding="utf-8")
+        for node in ("3989095437", "8154536771"):
+            self.assertNotIn('id="%s"' % node, nodes)
+        self.assertEqual(self.plain_files(), [])
+
+    def test_native_without_edge_types(self):
+        for name in ("subnetwork.net.xml", "subnetwork_corrected.net.xml"):
+            path = self.work_dir / name
+            lines = path.read_text(encoding="utf-8").splitlines(True)
+            path.write_text("".join(line for line in lines if "<type " not in line), encoding="utf-8")
+        self.compare("native", "--native", "--remove-plain")
+        self.assertEqual(diff_elements(self.work_dir / "native.typ.xml"), [])
+        self.assertEqual(self.plain_files(), [])
+
+    def test_jobs(self):
+        self.compare("default")
+        self.compare("jobs", "-j", "3")
+        self.assertSameText("jobs")
+
+    def test_spill_dir(self):
+        self.compare("default")
+        self.compare("spill", "--spill-dir", "spill")
+        self.assertSameText("spill")
+        # the temporary databases are removed
+        self.assertEqual(os.listdir(self.work_dir / "spill"), [])
+
+    def test_merge(self):
+        self.compare("default")
+        # the merge writes the elements in id order, the unsorted plain files
+        # (different ones for netconvert and net2plain.py) are sorted first
+        for outprefix, options in (("merge", ()), ("merge_native", ("--native",))):
+            self.compare(outprefix, "--merge", *options)
+            self.assertSameDiff(outprefix)
+
+    def test_geom_tolerance(self):
+        self.compare("default")
+        self.compare("geom", "--geom-tolerance", "0")
+        self.assertSameText("geom")
+        for name, text in (("s.nod.xml", SOURCE_NODES), ("d.nod.xml", DEST_NODES),
+                           ("s.edg.xml", SOURCE_EDGES), ("d.edg.xml", DEST_EDGES)):
+            (self.work_dir / name).write_text(text, encoding="utf-8")
+        self.netdiff("nodes", "--direct", "--geom-tolerance", "0.1", "s.nod.xml", "d.nod.xml")
+        self.assertEqual(diff_elements(self.work_dir / "nodes.xml"),
+                         ['<node id="b" type="traffic_light"></node>', '<node id="c" y="0.20"></node>',
+                          '<node id="d" x="300.08" y="0.08"></node>'])
+        self.netdiff("edges", "--direct", "--geom-tolerance", "0.1", "s.edg.xml", "d.edg.xml")
+        self.assertEqual(diff_elements(self.work_dir / "edges.xml"),
+                         ['<edge id="bc" shape="100.00,0.00 150.00,10.50 200.00,0.20"></edge>'])
+
+    def test_manifest_dir(self):
+        # the manifests of the first run are reused by the second one for plain
+        # files with the same content: netconvert writes a timestamp into the
+        # plain files, they are only unchanged when taken from the cache
+        for options in (("--cache-dir", "cache"), ("--native",)):
+            # the elements of the plain files of net2plain.py are in another order
+            self.compare("expected", *options)
+            manifest_dir = self.work_dir / ("manifests" + options[0])
+            self.compare("manifest", "--manifest-dir", str(manifest_dir), *options)
+            self.assertSameText("manifest", "expected")
+            manifests = sorted(os.listdir(manifest_dir))
+            self.assertTrue(manifests)
+            self.compare("manifest", "--manifest-dir", str(manifest_dir), *options)
+            self.assertSameText("manifest", "expected")
+            self.assertEqual(sorted(os.listdir(manifest_dir)), manifests, options)
+
+    def test_add_target(self):
+        # a second modified network with another diff than the corrected one
+        subprocess.run(["netconvert", "-s", "subnetwork.net.xml", "--remove-edges.explicit", "4306783#0",
+                        "-o", "other.net.xml"],
+                       cwd=self.work_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.compare("default")
+        # not "other", the prefix of the plain files of other.net.xml
+        self.netdiff("other_diff", "subnetwork.net.xml", "other.net.xml")
+        self.assertIn("4306783#0", diff_body(self.work_dir / "other_diff.edg.xml"))
+        # each target is compared with a view of the source read once
+        for options in ((), ("-j", "2")):
+            self.netdiff("targets", *options, "--add-target", "other.net.xml", "targets_other",
+                         "subnetwork.net.xml", "subnetwork_corrected.net.xml")
+            self.assertSameText("targets")
+            self.assertSameText("targets_other", "other_diff")
+
+
+if __name__ == "__main__":
+    unittest.main()
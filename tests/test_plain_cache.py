@@ -0,0 +1,96 @@
+"""
+Hits, misses, eviction and pins of the plain export cache.
+
+Requires netconvert, the test is skipped without netconvert.
+"""
+from pathlib import Path
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = Path(__file__).resolve().parent.parent
+DEMO = ROOT / "demo"
+sys.path.insert(0, str(ROOT / "src"))
+
+from plain_cache import PIN_MAX_AGE, PINS_DIR, PlainCache  # noqa: E402
+
+
+@unittest.skipIf(shutil.which("netconvert") is None, "netconvert is not installed")
+class PlainCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.cache_dir = self.work_dir / "cache"
+        self.networks = []
+        for name in ("subnetwork.net.xml", "subnetwork_corrected.net.xml"):
+            shutil.copy(DEMO / name, self.work_dir / name)
+            self.networks.append(self.work_dir / name)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def entries(self):
+        return sorted(entry.name for entry in self.cache_dir.iterdir()
+                      if entry.is_dir() and entry.name != PINS_DIR)
+
+    def test_hit_reuses_export(self):
+        cache = PlainCache(self.cache_dir, 1 << 30)
+        prefix = cache.export(self.networks[0])
+        stamp = Path(str(prefix) + ".nod.xml").stat().st_mtime_ns
+        cache.close()
+        other = PlainCache(self.cache_dir, 1 << 30)
+        self.assertEqual(other.export(self.networks[0]), prefix)
+        self.assertEqual(Path(str(prefix) + ".nod.xml").stat().st_mtime_ns, stamp)
+        other.close()
+        self.assertEqual(len(self.entries()), 1)
+
+    def test_miss_on_other_network_and_options(self):
+        cache = PlainCache(self.cache_dir, 1 << 30)
+        prefixes = {cache.export(self.networks[0]), cache.export(self.networks[1]),
+                    cache.export(self.networks[0], ["--plain.extend-edge-shape"])}
+        cache.close()
+        self.assertEqual(len(prefixes), 3)
+        self.assertEqual(len(self.entries()), 3)
+
+    def test_entry_config_is_usable(self):
+        cache = PlainCache(self.cache_dir, 1 << 30)
+        prefix = cache.export(self.networks[0])
+        cache.close()
+        # the configuration refers to the files of the entry, not the build directory
+        result = subprocess.run(["netconvert", "-c", str(prefix) + ".netccfg",
+                                 "-o", str(self.work_dir / "rebuilt.net.xml")],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.assertEqual(result.returncode, 0)
+
+    def test_eviction_keeps_pinned_entries(self):
+        first = PlainCache(self.cache_dir, 0)
+        first.export(self.networks[0])
+        second = PlainCache(self.cache_dir, 0)
+        second.export(self.networks[1])
+        # both entries are pinned by a process, none is evicted
+        self.assertEqual(len(self.entries()), 2)
+        first.close()
+        second.evict()
+        self.assertEqual(self.entries(), [second.key(self.networks[1])])
+        second.close()
+        second.evict()
+        self.assertEqual(self.entries(), [])
+
+    def test_stale_pin_expires(self):
+        cache = PlainCache(self.cache_dir, 0)
+        key = cache.key(self.networks[0])
+        cache.pin(key)
+        self.assertTrue(cache.is_pinned(key))
+        old = time.time() - PIN_MAX_AGE - 60
+        for pin in (self.cache_dir / PINS_DIR).glob(key + ".*"):
+            os.utime(pin, (old, old))
+        self.assertFalse(cache.is_pinned(key))
+        self.assertEqual(list((self.cache_dir / PINS_DIR).iterdir()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+The streamed subnetworks of taz_to_net.py hold the elements of the network
+that a selection on the whole parsed network finds.
+"""
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import xml.etree.ElementTree as ET
+
+ROOT = Path(__file__).resolve().parent.parent
+TAZ_TO_NET = ROOT / "src" / "additionals" / "taz_to_net.py"
+DEMO = ROOT / "demo"
+sys.path.insert(0, str(ROOT / "src" / "additionals"))
+
+import taz_to_net  # noqa: E402
+
+# -4306783#0 is only found as 4306783#0, the connections between the edges of
+# a are controlled by a traffic light
+TAZ_EDGES = {
+    "a": ["-4306783#0", "4306783#2", "62019359#0", "62019360#0", "155472438", "62017783#0", "675816099#0"],
+    "b": ["-236145787", "236145787", "62020114#0", "62020116#0", "62017785#0", "939752210", "-876140819"],
+}
+
+
+def canonical(elem):
+    elem.tail = None
+    return ET.canonicalize(ET.tostring(elem, encoding="unicode"), strip_text=True)
+
+
+def subnetwork_elements(net_file):
+    return [canonical(elem) for elem in ET.parse(net_file).getroot()]
+
+
+def expected_elements(net_file, taz_edges, buffered=False):
+    """
+    Return the elements of the network belonging to the subnetwork of
+    taz_edges, found on the whole parsed network. With buffered the edges
+    one hop away from the TAZ edges belong to it as well.
+    """
+    root = ET.parse(net_file).getroot()
+    edges = {edge.get("id"): edge for edge in root.findall("edge") if edge.get("from") is not None}
+    kept = set()
+    for edge_id in taz_edges:
+        reverse = edge_id[1:] if edge_id.startswith("-") else "-" + edge_id
+        kept.add(edge_id if edge_id in edges else reverse)
+    nodes = set(edges[edge_id].get(end) for edge_id in kept for end in ("from", "to"))
+    if buffered:
+        kept.update(edge_id for edge_id, edge in edges.items() if edge.get("from") in nodes or edge.get("to") in nodes)
+        nodes = set(edges[edge_id].get(end) for edge_id in kept for end in ("from", "to"))
+    types = set(edges[edge_id].get("type") for edge_id in kept)
+    tls = set(connection.get("tl") for connection in root.findall("connection")
+              if connection.get("from") in kept and connection.get("to") in kept)
+    wanted = {"edge": lambda elem: elem.get("id") in kept,
+              "junction": lambda elem: elem.get("id") in nodes,
+              "connection": lambda elem: elem.get("from") in kept and elem.get("to") in kept,
+              "type": lambda elem: elem.get("id") in types,
+              "tlLogic": lambda elem: elem.get("id") in tls}
+    return [canonical(elem) for elem in root if elem.tag in wanted and wanted[elem.tag](elem)]
+
+
+class TazToNetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = Path(tempfile.mkdtemp())
+        self.network = self.work_dir / "network.net.xml"
+        shutil.copy(DEMO / "subnetwork.net.xml", self.network)
+        taz_file = self.work_dir / "areas.taz.xml"
+        taz_file.write_text("<tazs>\n%s</tazs>\n" % "".join(
+            '    <taz id="%s" edges="%s"/>\n' % (taz_id, " ".join(edges)) for taz_id, edges in TAZ_EDGES.items()),
+            encoding="utf-8")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def extract(self, output, *options):
+        subprocess.run([sys.executable, str(TAZ_TO_NET), *options, "areas.taz.xml", "network.net.xml", output],
+                       cwd=self.work_dir, check=True, stdout=subprocess.DEVNULL)
+        return self.work_dir / output
+
+    def test_subnetwork_keeps_original_elements(self):
+        # without --batch the edges of all TAZ form one subnetwork
+        expected = expected_elements(self.network, TAZ_EDGES["a"] + TAZ_EDGES["b"])
+        self.assertTrue(any(elem.startswith("<tlLogic") for elem in expected))
+        self.assertEqual(subnetwork_elements(self.extract("all.net.xml")), expected)
+
+    def test_buffer_hops_keeps_original_elements(self):
+        expected = expected_elements(self.network, TAZ_EDGES["a"], True)
+        self.assertGreater(len(expected), len(expected_elements(self.network, TAZ_EDGES["a"])))
+        taz_file = self.work_dir / "areas.taz.xml"
+        taz_file.write_text('<tazs>\n    <taz id="a" edges="%s"/>\n</tazs>\n' % " ".join(TAZ_EDGES["a"]),
+                            encoding="utf-8")
+        # the second run takes the edge index cached by the first one instead of the first pass
+        for run in range(2):
+            self.assertEqual(subnetwork_elements(self.extract("hops.net.xml", "--buffer-hops", "1")), expected)
+        self.assertTrue((self.work_dir / "network.net.xml.taz_index.pkl").exists())
+
+    def test_batch_keeps_original_elements(self):
+        batch = self.extract("batch", "--batch")
+        for taz_id, edges in TAZ_EDGES.items():
+            self.assertEqual(subnetwork_elements(batch / ("%s.net.xml" % taz_id)),
+                             expected_elements(self.network, edges), taz_id)
+
+    @unittest.skipIf(taz_to_net.STRtree is None, "shapely>=2 is not installed")
+    def test_by_shape_without_spatial_index(self):
+        polygons = taz_to_net.read_polygons(str(DEMO / "subnetwork.taz.xml"), str(self.network))
+        lane_shapes = taz_to_net.read_lane_shapes(str(self.network))
+        expected = taz_to_net.edges_in_polygons(polygons, lane_shapes)
+        self.assertTrue(expected["0"])
+        with mock.patch.object(taz_to_net, "STRtree", None):
+            self.assertEqual(taz_to_net.edges_in_polygons(polygons, lane_shapes), expected)
+
+    def test_geojson_needs_pyproj(self):
+        geojson = self.work_dir / "areas.geojson"
+        geojson.write_text('{"type": "FeatureCollection", "features": []}', encoding="utf-8")
+        # the corrected demo subnetwork is geo-referenced
+        with mock.patch.dict(sys.modules, {"pyproj": None}):
+            with self.assertRaisesRegex(SystemExit, "pyproj is needed"):
+                taz_to_net.read_polygons(str(geojson), str(DEMO / "subnetwork_corrected.net.xml"))
+
+
+if __name__ == "__main__":
+    unittest.main()